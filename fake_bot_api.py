@@ -0,0 +1,307 @@
+# fake_bot_api.py - 本地 Bot API 替身服务器, 用于离线的端到端吞吐测试
+#
+# 用法: python3 fake_bot_api.py [--port 8081] [--synthetic 1000] [--latency 0.05] [--error-rate 0.01]
+# 然后在 config.ini 的 [Telegram] 中设置 API_BASE_URL = http://127.0.0.1:8081/bot 并启动机器人。
+#
+# 模拟机器人用到的 Bot API 子集 (getUpdates / sendMessage / forwardMessage / copyMessage /
+# editMessageText / answerCallbackQuery 等), 按 Telegram 的限制对发送类方法做每会话与全局限流,
+# 超限返回 429 与 retry_after; 可注入延迟、超时 (挂起不响应) 和随机错误。
+# 每次调用都记录到 NDJSON 日志, 退出时打印汇总。只依赖标准库。
+import argparse
+import gzip
+import json
+import math
+import random
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+GLOBAL_RATE = 30        # 全局: 每秒最多发送条数
+CHAT_RATE = 1           # 私聊: 每会话每秒条数
+GROUP_RATE = 20         # 群组: 每会话每分钟条数
+MAX_UPDATES = 100       # getUpdates 单次最多返回条数
+
+# 受限流约束的发送类方法
+SEND_METHODS = ("sendmessage", "forwardmessage", "forwardmessages", "copymessage", "copymessages",
+                "editmessagetext", "editmessagereplymarkup", "senddocument", "sendphoto")
+
+# ==================== 返回值构造 ====================
+def make_message(chat_id, message_id: int, bot_user: dict, text: str = None) -> dict:
+    message = {
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": int(chat_id), "type": "private" if int(chat_id) > 0 else "supergroup"},
+        "from": bot_user,
+    }
+    if text is not None:
+        message["text"] = text
+    return message
+
+def simulate_result(method: str, params: dict, bot_user: dict, next_id):
+    """按方法构造一个格式正确的成功返回值; next_id() 产生递增的消息ID"""
+    method = method.lower()
+    if method == "getme":
+        return bot_user
+    if method == "getupdates":
+        return []
+    if method == "copymessage":
+        return {"message_id": next_id()}
+    if method in ("copymessages", "forwardmessages"):
+        return [{"message_id": next_id()} for _ in params.get("message_ids", [])]
+    if method == "createforumtopic":
+        return {"message_thread_id": next_id(), "name": params.get("name", ""), "icon_color": 0}
+    if method == "getchat":
+        chat_id = int(params["chat_id"])
+        return {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup",
+                "accent_color_id": 0, "max_reaction_count": 0,
+                "accepted_gift_types": {"unlimited_gifts": False, "limited_gifts": False,
+                                        "unique_gifts": False, "premium_subscription": False}}
+    if method.startswith(("send", "forward")) or (method.startswith("edit") and "chat_id" in params):
+        return make_message(params["chat_id"], params.get("message_id") or next_id(), bot_user,
+                            params.get("text"))
+    return True
+
+# ==================== 限流 ====================
+class SlidingWindow:
+    """滑动窗口计数: 窗口内超过上限时返回需要等待的秒数"""
+
+    def __init__(self, limit: int, period: float):
+        self.limit = limit
+        self.period = period
+        self.hits = deque()
+
+    def acquire(self, now: float) -> float:
+        while self.hits and self.hits[0] <= now - self.period:
+            self.hits.popleft()
+        if len(self.hits) >= self.limit:
+            return self.hits[0] + self.period - now
+        self.hits.append(now)
+        return 0.0
+
+# ==================== 服务器状态 ====================
+class FakeBotApi:
+    """所有连接共享的状态: 待下发的更新、限流窗口、调用记录"""
+
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.updates_ready = threading.Condition(self.lock)
+        self.updates = deque()
+        self.global_window = SlidingWindow(args.global_rate, 1.0)
+        self.chat_windows = {}
+        self.forbidden = set(args.forbidden)
+        self.calls = Counter()
+        self.statuses = Counter()
+        self._message_id = 0
+        self._update_id = 0
+        self.log = open(args.log, "a", encoding="utf-8") if args.log else None
+
+    def next_id(self) -> int:
+        with self.lock:
+            self._message_id += 1
+            return self._message_id
+
+    # === 更新来源 ===
+    def load_recording(self, path: str):
+        """载入 /record 录制的流量 (首行元信息跳过)"""
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                if "update" in record:
+                    self.push_update(record["update"])
+
+    def add_synthetic(self, count: int, users: int, owner_id: int):
+        """生成 count 条来自 users 个用户的私聊文本消息"""
+        for i in range(count):
+            user_id = 10**9 + random.randrange(users)
+            if user_id == owner_id:
+                continue
+            sender = {"id": user_id, "is_bot": False, "first_name": f"User{user_id % 10000}"}
+            self.push_update({"message": {
+                "message_id": i + 1,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private", "first_name": sender["first_name"]},
+                "from": sender,
+                "text": f"synthetic message {i}",
+            }})
+
+    def push_update(self, update: dict):
+        with self.updates_ready:
+            self._update_id += 1
+            update = dict(update, update_id=self._update_id)
+            self.updates.append(update)
+            self.updates_ready.notify_all()
+
+    def get_updates(self, params: dict) -> list:
+        """长轮询语义: 确认 offset 之前的更新, 无更新时最多等待 timeout 秒"""
+        offset = int(params.get("offset", 0) or 0)
+        limit = min(int(params.get("limit", MAX_UPDATES) or MAX_UPDATES), MAX_UPDATES)
+        deadline = time.monotonic() + float(params.get("timeout", 0) or 0)
+        with self.updates_ready:
+            while self.updates and self.updates[0]["update_id"] < offset:
+                self.updates.popleft()
+            while not self.updates and time.monotonic() < deadline:
+                self.updates_ready.wait(deadline - time.monotonic())
+            return list(self.updates)[:limit]
+
+    # === 限流与故障 ===
+    def check_rate(self, chat_id) -> float:
+        """返回需要等待的秒数, 0 表示放行"""
+        now = time.monotonic()
+        with self.lock:
+            wait = self.global_window.acquire(now)
+            if wait or chat_id is None:
+                return wait
+            window = self.chat_windows.get(chat_id)
+            if window is None:
+                window = (SlidingWindow(self.args.chat_rate, 1.0) if chat_id > 0
+                          else SlidingWindow(self.args.group_rate, 60.0))
+                self.chat_windows[chat_id] = window
+            return window.acquire(now)
+
+    def handle(self, token: str, method: str, params: dict):
+        """返回 (HTTP 状态码, 响应体)"""
+        lowered = method.lower()
+        bot_user = {"id": int(token.split(":")[0] or 0), "is_bot": True,
+                    "first_name": "FakeBot", "username": "fake_bot"}
+
+        if self.args.latency or self.args.jitter:
+            time.sleep(self.args.latency + random.uniform(0, self.args.jitter))
+        if lowered != "getupdates" and random.random() < self.args.timeout_rate:
+            # 挂起直到客户端读超时
+            time.sleep(self.args.hang)
+        if lowered != "getupdates" and random.random() < self.args.error_rate:
+            return 502, {"ok": False, "error_code": 502, "description": "Bad Gateway"}
+
+        chat_id = params.get("chat_id")
+        chat_id = int(chat_id) if chat_id not in (None, "") else None
+        if lowered in SEND_METHODS:
+            if chat_id in self.forbidden:
+                return 403, {"ok": False, "error_code": 403,
+                             "description": "Forbidden: bot was blocked by the user"}
+            wait = self.check_rate(chat_id)
+            if wait:
+                retry_after = max(1, math.ceil(wait))
+                return 429, {"ok": False, "error_code": 429,
+                             "description": f"Too Many Requests: retry after {retry_after}",
+                             "parameters": {"retry_after": retry_after}}
+
+        if lowered == "getupdates":
+            result = self.get_updates(params)
+        else:
+            result = simulate_result(method, params, bot_user, self.next_id)
+        return 200, {"ok": True, "result": result}
+
+    def record(self, method: str, params: dict, status: int, elapsed: float):
+        with self.lock:
+            self.calls[method] += 1
+            self.statuses[status] += 1
+            if self.log:
+                self.log.write(json.dumps({
+                    "t": round(time.time(), 3), "method": method, "chat_id": params.get("chat_id"),
+                    "status": status, "ms": round(elapsed * 1000, 2),
+                }) + "\n")
+
+    def summary(self) -> str:
+        lines = [f"共 {sum(self.calls.values())} 次调用, 状态码: {dict(self.statuses)}"]
+        lines.extend(f"  {method}: {count}" for method, count in self.calls.most_common())
+        lines.append(f"未下发的更新: {len(self.updates)}")
+        return "\n".join(lines)
+
+# ==================== HTTP 层 ====================
+def parse_params(content_type: str, body: bytes) -> dict:
+    """python-telegram-bot 以表单提交, 复杂参数的值为 JSON 字符串"""
+    if content_type.startswith("application/json"):
+        return json.loads(body or b"{}")
+    params = {}
+    if content_type.startswith("multipart/form-data"):
+        # 文件上传只需要普通字段
+        boundary = content_type.split("boundary=", 1)[1].strip('"').encode()
+        for part in body.split(b"--" + boundary):
+            head, _, value = part.partition(b"\r\n\r\n")
+            if b'name="' not in head or b"filename=" in head:
+                continue
+            name = head.split(b'name="', 1)[1].split(b'"', 1)[0].decode()
+            params[name] = value.rstrip(b"\r\n").decode("utf-8", "replace")
+    else:
+        params = dict(parse_qsl(body.decode("utf-8")))
+    for key, value in params.items():
+        try:
+            params[key] = json.loads(value)
+        except (TypeError, ValueError):
+            pass
+    return params
+
+def make_handler(api: FakeBotApi):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"   # 保持连接, 与真实服务一样复用连接池
+
+        def do_POST(self):
+            started = time.perf_counter()
+            # 路径格式: /bot<token>/<method>
+            _, _, rest = self.path.partition("/bot")
+            token, _, method = rest.partition("/")
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            params = parse_params(self.headers.get("Content-Type", ""), body)
+            status, payload = api.handle(token, method, params)
+            data = json.dumps(payload).encode()
+            try:
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            except OSError:
+                status = 0  # 客户端已超时断开
+            api.record(method, params, status, time.perf_counter() - started)
+
+        do_GET = do_POST
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+def main():
+    parser = argparse.ArgumentParser(description="本地 Bot API 替身服务器 (限流与故障注入)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--updates", help="用 /record 录制的 .ndjson.gz 作为 getUpdates 的来源")
+    parser.add_argument("--synthetic", type=int, default=0, help="生成的私聊消息条数")
+    parser.add_argument("--users", type=int, default=100, help="合成消息的发送者人数")
+    parser.add_argument("--owner-id", type=int, default=0, help="合成消息排除的主人ID")
+    parser.add_argument("--global-rate", type=int, default=GLOBAL_RATE, help="全局每秒发送上限")
+    parser.add_argument("--chat-rate", type=int, default=CHAT_RATE, help="私聊每会话每秒上限")
+    parser.add_argument("--group-rate", type=int, default=GROUP_RATE, help="群组每会话每分钟上限")
+    parser.add_argument("--latency", type=float, default=0.0, help="每次调用的固定延迟(秒)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="额外的随机延迟上限(秒)")
+    parser.add_argument("--timeout-rate", type=float, default=0.0, help="挂起不响应的概率")
+    parser.add_argument("--hang", type=float, default=30.0, help="挂起时长(秒), 应大于客户端读超时")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回 502 的概率")
+    parser.add_argument("--forbidden", type=int, nargs="*", default=[], help="视为已拉黑机器人的会话ID")
+    parser.add_argument("--log", help="逐次调用记录 (NDJSON) 的输出文件")
+    args = parser.parse_args()
+
+    api = FakeBotApi(args)
+    if args.updates:
+        api.load_recording(args.updates)
+    if args.synthetic:
+        api.add_synthetic(args.synthetic, args.users, args.owner_id)
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(api))
+    server.daemon_threads = True
+    print(f"Bot API 替身已启动: http://{args.host}:{args.port}/bot  (待下发更新 {len(api.updates)} 条)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if api.log:
+            api.log.close()
+        print("\n" + api.summary())
+
+if __name__ == '__main__':
+    main()
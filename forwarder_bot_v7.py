@@ -1,17 +1,45 @@
 # forwarder_bot_v7.py - 全面重构版本
 import random
 import logging
+import hmac
+import html
+import hashlib
+import base64
+from collections import OrderedDict
 import configparser
 import json
 import os
+import asyncio
+import csv
+import gzip
+import tempfile
+import time
+import io
+import sys
+import cProfile
+import pstats
+import threading
+import gc
+import tracemalloc
+import uuid
+import re
+from urllib.parse import urlsplit
+import traceback
+import signal
+from collections import Counter, deque
+from bisect import bisect_left, insort
 from datetime import datetime
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram import (
+    Update, InlineKeyboardMarkup, InlineKeyboardButton,
+    MessageEntity
+)
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, 
-    filters, ContextTypes, CallbackQueryHandler
+    filters, ContextTypes, CallbackQueryHandler, CallbackContext,
+    TypeHandler, ApplicationHandlerStop
 )
 from telegram.constants import ParseMode
-from telegram.error import TelegramError
+from telegram.error import TelegramError, RetryAfter, Forbidden, BadRequest, NetworkError, TimedOut
 
 # ==================== 配置区 ====================
 CONFIG_FILE = 'config.ini'
@@ -21,8 +49,81 @@ WHITELIST_FILE = os.path.join(DATA_DIR, 'whitelist.json')
 BLACKLIST_FILE = os.path.join(DATA_DIR, 'blacklist.json')
 STATS_FILE = os.path.join(DATA_DIR, 'statistics.json')
 PENDING_VERIFY_FILE = os.path.join(DATA_DIR, 'pending_verify.json')
+STATE_FILE = os.path.join(DATA_DIR, 'runtime_state.json')
+LAST_SEEN_FILE = os.path.join(DATA_DIR, 'last_seen.json')
+INACTIVE_FILE = os.path.join(DATA_DIR, 'inactive_users.json')
+TOPICS_FILE = os.path.join(DATA_DIR, 'user_topics.json')
+ASSIGNMENTS_FILE = os.path.join(DATA_DIR, 'assignments.json')
+OUTBOX_FILE = os.path.join(DATA_DIR, 'outbox.json')
+HISTORY_FILE = os.path.join(DATA_DIR, 'history.ndjson')
+BACKLOG_FILE = os.path.join(DATA_DIR, 'backlog.ndjson')
+BACKLOG_DONE_FILE = os.path.join(DATA_DIR, 'backlog_done.txt')
+FILTER_FILE = os.path.join(DATA_DIR, 'filters.txt')
 
 MAX_FAIL_LIMIT = 3
+# 回复路由模式:
+#   "mapping"   - 转发消息并记录 消息ID -> 用户ID 映射 (默认)
+#   "stateless" - 复制消息并把用户ID编码在其操作面板按钮中, 不写映射
+ROUTING_MODE = "mapping"
+# 验证模式:
+#   "text"    - 回复数字答案, 题目与尝试次数保存在 pending_verify (默认)
+#   "buttons" - 选择题按钮, 题目/有效期/次数以 HMAC 签名编码在 callback_data 中, 不落盘
+VERIFY_MODE = "text"
+# 多客服分配策略 (配置了 OPERATORS 时生效): "least_loaded" 分给会话最少的客服, "round_robin" 轮流分配
+ASSIGN_STRATEGY = "least_loaded"
+VERIFY_TTL = 300                # 按钮题目有效期(秒)
+# 按钮模式盲猜通过率 = 可作答次数 / 选项个数 (24 选 2 次约 8%; 文本模式 3 次猜 11~59 约 6%)
+VERIFY_CHOICES = 24             # 选项个数
+VERIFY_CHOICE_COLUMNS = 6       # 每行按钮数
+VERIFY_BUTTON_ATTEMPTS = 2      # 按钮模式可作答次数
+VERIFY_STRIKE_CACHE = 100000    # 内存中记录的按钮验证失败人数上限
+LIST_PAGE_SIZE = 10     # 黑/白名单每页条数
+IMPORT_CHUNK_SIZE = 5000        # 批量导入每批行数
+PROGRESS_INTERVAL = 2.0         # 进度消息最短刷新间隔(秒)
+PROFILE_MAX_SECONDS = 300       # /profile 最长采集时间
+PROFILE_SAMPLE_INTERVAL = 0.005 # 火焰图采样间隔(秒)
+RECORD_OWNER_ID = 1             # 录制文件中主人的匿名ID (回放时作为 OWNER_ID)
+RECORD_BOT_ID = 2               # 录制文件中机器人自身的匿名ID
+MEMSTATS_TOP = 10               # /memstats 每项列出的条目数
+MEMSTATS_TRACE_FRAMES = 1       # 内存分配追踪保留的调用栈深度
+MEMSTATS_FIELDS = ("user_mapping", "whitelist", "blacklist", "pending_verify",
+                   "last_seen", "inactive", "assignments", "outbox", "history")
+LAG_SAMPLE_INTERVAL = 0.5       # 事件循环延迟采样间隔(秒)
+LAG_WINDOW = 1200               # 保留的延迟样本数 (约10分钟)
+SLOW_CALLBACK_THRESHOLD = 0.5   # 单次占用事件循环超过此值(秒)记录调用栈
+LAG_ALERT_THRESHOLD = 1.0       # 持续延迟告警阈值(秒)
+LAG_ALERT_SUSTAIN = 10          # 连续超过阈值的样本数才告警
+LAG_ALERT_COOLDOWN = 600        # 告警冷却时间(秒)
+BROADCAST_CONCURRENCY = 20      # 群发最大并发请求数
+BROADCAST_RATE = 25             # 群发全局速率(条/秒), 低于 Telegram 的 30 条/秒
+BROADCAST_MAX_RETRIES = 3       # 遇到 429 时的最大重试次数
+ALBUM_CACHE_SIZE = 50           # 记录主人最近发送的相册数量
+# 摘要模式: "auto" 入站速率超过阈值时自动开启, "on" 始终开启, "off" 关闭
+DIGEST_MODE = "auto"
+DIGEST_WINDOW = 30              # 摘要收集窗口(秒)
+DIGEST_RATE_THRESHOLD = 20      # 自动开启的入站速率(条/分钟)
+DIGEST_PREVIEW_LEN = 30         # 摘要中每条预览的最大长度
+DIGEST_MAX_USERS = 30           # 单条摘要最多列出的用户数
+OUTBOX_POLL_INTERVAL = 1.0      # 发件箱检查间隔(秒)
+OUTBOX_CONCURRENCY = 5          # 发件箱最大并发发送数
+OUTBOX_MAX_ATTEMPTS = 8         # 最大重试次数, 超过后才报告失败
+OUTBOX_BASE_DELAY = 2.0         # 退避基数(秒), 第 n 次重试约等待 基数 × 2^n
+OUTBOX_MAX_DELAY = 600          # 单次退避上限(秒)
+HISTORY_PER_USER = 20           # 每个用户保留的最近往来条数
+HISTORY_MAX_ENTRIES = 200000    # 全部用户合计的记录上限, 超出时淘汰最久未活跃用户的最早记录
+HISTORY_PREVIEW_LEN = 40        # 历史记录中的预览长度
+PROCESSED_RING_SIZE = 5000      # 记录最近处理过的更新/消息键数量 (用于去重)
+FLUSH_INTERVAL = 5              # 脏数据定时落盘间隔(秒)
+SHUTDOWN_DRAIN_TIMEOUT = 5      # 停机时等待处理中更新的最长时间(秒)
+HEADER_SUPPRESSION = True       # 同一用户连续发消息时省略信息头和操作面板
+HEADER_REPEAT_TIMEOUT = 300     # 距上次显示信息头超过此时间(秒)则重新显示
+REPEAT_WINDOW = 600             # 重复内容的判定窗口(秒), 从首次出现算起
+REPEAT_MAX_ENTRIES = 50000      # 指纹表容量上限 (按用户、全局各一张)
+FLOOD_USER_THRESHOLD = 5        # 窗口内发送相同内容的不同用户数达到此值视为刷屏
+FLOOD_MIN_TEXT_LEN = 20         # 参与刷屏判定的最短文本 (过短的如"你好"很常见)
+FLOOD_AUTO_BLOCK = False        # 刷屏时是否自动拉黑发送者
+CATCHUP_THRESHOLD = 50          # 启动时积压的更新数达到此值进入补处理模式
+CATCHUP_MAX_UPDATES = 20000     # 补处理最多拉取的更新数, 其余交给正常轮询
 BOT_VERSION = "7.0"
 
 # ==================== 日志配置 ====================
@@ -37,6 +138,173 @@ logging.basicConfig(
 logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
+# ==================== 有序ID集合 ====================
+class SortedIdSet:
+    """带有序索引的用户ID集合: O(1) 成员判断, O(log n + k) 游标分页"""
+    
+    def __init__(self, items=()):
+        self._members = set(items)
+        self._order = sorted(self._members)
+    
+    def __contains__(self, user_id) -> bool:
+        return user_id in self._members
+    
+    def __len__(self) -> int:
+        return len(self._members)
+    
+    def __iter__(self):
+        return iter(self._order)
+    
+    def add(self, user_id: int):
+        if user_id not in self._members:
+            self._members.add(user_id)
+            insort(self._order, user_id)
+    
+    def discard(self, user_id: int):
+        if user_id in self._members:
+            self._members.discard(user_id)
+            del self._order[bisect_left(self._order, user_id)]
+    
+    def clear(self):
+        self._members.clear()
+        self._order.clear()
+    
+    def update(self, user_ids):
+        """批量加入: 追加后原地排序, timsort 在 C 层合并两段有序序列, O(n + k log k)"""
+        new_ids = set(user_ids) - self._members
+        if new_ids:
+            self._members.update(new_ids)
+            self._order.extend(new_ids)
+            self._order.sort()
+    
+    def difference_update(self, user_ids):
+        """批量移除: 一次线性过滤重建索引"""
+        removed = self._members.intersection(user_ids)
+        if removed:
+            self._members -= removed
+            self._order = [uid for uid in self._order if uid not in removed]
+    
+    def page(self, start=None, size: int = LIST_PAGE_SIZE):
+        """
+        从游标 start (含) 开始取一页
+        返回: (本页ID列表, 上一页游标或None, 下一页游标或None)
+        """
+        i = 0 if start is None else bisect_left(self._order, start)
+        items = self._order[i:i + size]
+        prev_start = self._order[max(0, i - size)] if i > 0 else None
+        next_start = self._order[i + size] if i + size < len(self._order) else None
+        return items, prev_start, next_start
+
+# ==================== 去重记录 ====================
+class ProcessedRing:
+    """定长的已处理键记录: O(1) 判重, 超出容量时淘汰最早的键"""
+    
+    def __init__(self, maxlen: int, items=()):
+        self._order = deque(maxlen=maxlen)
+        self._members = set()
+        for key in items:
+            self.add(key)
+    
+    def __contains__(self, key) -> bool:
+        return key in self._members
+    
+    def __iter__(self):
+        return iter(self._order)
+    
+    def add(self, key):
+        if key in self._members:
+            return
+        if len(self._order) == self._order.maxlen:
+            self._members.discard(self._order[0])
+        self._order.append(key)
+        self._members.add(key)
+
+# ==================== 会话历史 ====================
+class ConversationHistory:
+    """
+    每个用户最近 N 条往来记录的环形缓冲: 按用户 O(1) 查询, 全局条数有上限
+    持久化为追加写的日志 (NDJSON), 日志膨胀到实际记录数的数倍时整体重写压缩
+    """
+    
+    def __init__(self, per_user: int, max_entries: int):
+        self.per_user = per_user
+        self.max_entries = max_entries
+        self._users = OrderedDict()     # {user_id: deque([时间戳, 方向, 类型, 预览])}, 按最近活跃排序
+        self.counts = {}                # {user_id: 收到的消息总数}
+        self.size = 0
+        self._pending = []              # 尚未写入日志的记录
+        self._journal_lines = 0
+    
+    def add(self, user_id: int, direction: str, kind: str, preview: str, ts: int = None, journal: bool = True):
+        """记录一条往来, direction 为 "in" (用户发来) 或 "out" (回复用户)"""
+        ring = self._users.get(user_id)
+        if ring is None:
+            ring = self._users[user_id] = deque(maxlen=self.per_user)
+        else:
+            self._users.move_to_end(user_id)
+        if len(ring) == ring.maxlen:
+            self.size -= 1
+        entry = [ts or int(time.time()), direction, kind, preview]
+        ring.append(entry)
+        self.size += 1
+        if direction == "in":
+            self.counts[user_id] = self.counts.get(user_id, 0) + 1
+        if journal:
+            self._pending.append([user_id] + entry)
+        
+        while self.size > self.max_entries:
+            oldest_id, oldest = next(iter(self._users.items()))
+            oldest.popleft()
+            self.size -= 1
+            if not oldest:
+                del self._users[oldest_id]
+                self.counts.pop(oldest_id, None)
+    
+    def __len__(self) -> int:
+        return self.size
+    
+    def recent(self, user_id: int) -> list:
+        return list(self._users.get(user_id, ()))
+    
+    def load(self, filepath: str):
+        """读取日志: 压缩后的行为 {"u", "n", "items"}, 追加的行为 [user_id, 时间戳, 方向, 类型, 预览]"""
+        if not os.path.exists(filepath):
+            return
+        try:
+            with open(filepath, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    self._journal_lines += 1
+                    if isinstance(record, dict):
+                        for item in record["items"]:
+                            self.add(record["u"], *item[1:], ts=item[0], journal=False)
+                        self.counts[record["u"]] = record["n"]
+                    else:
+                        self.add(record[0], *record[2:], ts=record[1], journal=False)
+        except (OSError, ValueError, KeyError, IndexError) as e:
+            logger.error(f"加载 {filepath} 失败: {e}")
+    
+    def save(self, filepath: str):
+        """追加新记录; 日志行数超过实际条数的 3 倍时重写"""
+        try:
+            if self._journal_lines + len(self._pending) > 3 * self.size + 1000:
+                tmp_path = filepath + '.tmp'
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    for user_id, ring in self._users.items():
+                        f.write(json.dumps({"u": user_id, "n": self.counts.get(user_id, 0),
+                                            "items": list(ring)}, ensure_ascii=False) + "\n")
+                os.replace(tmp_path, filepath)
+                self._journal_lines = len(self._users)
+            elif self._pending:
+                with open(filepath, 'a', encoding='utf-8') as f:
+                    f.writelines(json.dumps(item, ensure_ascii=False) + "\n" for item in self._pending)
+                self._journal_lines += len(self._pending)
+            self._pending = []
+        except OSError as e:
+            logger.error(f"保存 {filepath} 失败: {e}")
+
 # ==================== 数据管理类 ====================
 class DataManager:
     """统一数据持久化管理"""
@@ -45,19 +313,42 @@ class DataManager:
         os.makedirs(DATA_DIR, exist_ok=True)
         self.owner_id = 0
         self.bot_token = ""
+        self.verify_secret = b""
+        self.forum_chat_id = 0      # 话题模式的论坛超级群ID, 0 表示投递到主人私聊
+        self.operators = []         # 除主人外的客服ID
+        self.api_base_url = ""      # 自定义 Bot API 地址, 空表示官方服务器
         
         # 内存数据
         self.user_mapping = {}      # 消息ID -> 用户ID
-        self.whitelist = set()      # 白名单
-        self.blacklist = set()      # 黑名单
+        self.whitelist = SortedIdSet()  # 白名单
+        self.blacklist = SortedIdSet()  # 黑名单
         self.pending_verify = {}    # 待验证: {user_id: {"answer": int, "attempts": int}}
         self.statistics = {         # 统计数据
             "total_messages": 0,
             "total_replies": 0,
             "blocked_attempts": 0,
             "verified_users": 0,
+            "filtered_messages": 0,
+            "suppressed_repeats": 0,
             "start_time": None
         }
+        self.runtime_state = {      # 运行状态: 轮询进度与上次退出情况
+            "last_update_id": 0,
+            "clean_shutdown": False,
+            "stopped_at": None
+        }
+        self.processed = ProcessedRing(PROCESSED_RING_SIZE)  # 最近处理过的更新与消息键
+        self.last_seen = {}         # 最后活跃: {user_id: unix时间戳}
+        self._seen_by_day = {}      # 按天分桶的活跃索引: {天序号: {user_id, ...}}
+        self.user_topics = {}       # 话题模式: {user_id: message_thread_id}
+        self.topic_users = {}       # 反向索引: {message_thread_id: user_id}
+        self.assignments = {}       # 会话分配: {user_id: operator_id}
+        self._operator_load = Counter()  # 每位客服当前分配的会话数
+        self._round_robin = 0
+        self.outbox = []            # 待重试的发送任务 (按入队顺序)
+        self.history = ConversationHistory(HISTORY_PER_USER, HISTORY_MAX_ENTRIES)
+        self.inactive = {}          # 不可达用户: {user_id: {"reason": str, "since": iso时间}}
+        self._dirty = set()         # 待落盘的数据名
         
     def load_all(self):
         """加载所有配置和数据"""
@@ -67,6 +358,17 @@ class DataManager:
         self._load_json(BLACKLIST_FILE, 'blacklist', as_set=True)
         self._load_json(PENDING_VERIFY_FILE, 'pending_verify', key_type=int)
         self._load_json(STATS_FILE, 'statistics')
+        self._load_json(STATE_FILE, 'runtime_state')
+        self.processed = ProcessedRing(PROCESSED_RING_SIZE, self.runtime_state.get("recent_keys", []))
+        self._load_json(LAST_SEEN_FILE, 'last_seen', key_type=int)
+        self._load_json(INACTIVE_FILE, 'inactive', key_type=int)
+        self._load_json(TOPICS_FILE, 'user_topics', key_type=int)
+        self.topic_users = {tid: uid for uid, tid in self.user_topics.items()}
+        self._load_json(ASSIGNMENTS_FILE, 'assignments', key_type=int)
+        self._load_json(OUTBOX_FILE, 'outbox')
+        self.history.load(HISTORY_FILE)
+        self._operator_load = Counter(self.assignments.values())
+        self._rebuild_seen_index()
         
         if self.statistics.get("start_time") is None:
             self.statistics["start_time"] = datetime.now().isoformat()
@@ -84,6 +386,15 @@ class DataManager:
             config.read(CONFIG_FILE, encoding='utf-8')
             self.bot_token = config['Telegram']['BOT_TOKEN']
             self.owner_id = int(config['Telegram']['OWNER_ID'])
+            self.forum_chat_id = int(config['Telegram'].get('FORUM_CHAT_ID', '0') or 0)
+            # 自定义 Bot API 地址 (自建 Bot API 服务器或 fake_bot_api.py 测试替身)
+            self.api_base_url = config['Telegram'].get('API_BASE_URL', '').strip()
+            self.operators = [int(op) for op in config['Telegram'].get('OPERATORS', '').split(',')
+                              if op.strip() and int(op) != self.owner_id]
+            # 验证签名密钥, 未配置时由 Token 派生 (重启后保持一致)
+            secret = config['Telegram'].get('VERIFY_SECRET', '')
+            self.verify_secret = (secret.encode() if secret
+                                  else hashlib.sha256(b"verify:" + self.bot_token.encode()).digest())
         except (KeyError, ValueError) as e:
             logger.critical(f"配置文件格式错误: {e}")
             exit(1)
@@ -94,8 +405,10 @@ class DataManager:
             if os.path.exists(filepath):
                 with open(filepath, 'r', encoding='utf-8') as f:
                     data = json.load(f)
-                    if as_set:
-                        setattr(self, attr_name, set(data))
+                    if isinstance(data, list) and isinstance(getattr(self, attr_name), list):
+                        setattr(self, attr_name, data)
+                    elif as_set:
+                        setattr(self, attr_name, SortedIdSet(data))
                     elif key_type:
                         setattr(self, attr_name, {key_type(k): v for k, v in data.items()})
                     else:
@@ -104,13 +417,15 @@ class DataManager:
             logger.error(f"加载 {filepath} 失败: {e}")
     
     def _save_json(self, filepath, data):
-        """通用JSON保存"""
+        """通用JSON保存 (先写临时文件再替换, 中途被杀不会损坏原文件)"""
+        tmp_path = filepath + '.tmp'
         try:
-            with open(filepath, 'w', encoding='utf-8') as f:
-                if isinstance(data, set):
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                if isinstance(data, (set, SortedIdSet)):
                     json.dump(list(data), f, ensure_ascii=False, indent=2)
                 else:
                     json.dump(data, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, filepath)
         except Exception as e:
             logger.error(f"保存 {filepath} 失败: {e}")
     
@@ -129,6 +444,93 @@ class DataManager:
     def save_stats(self):
         self._save_json(STATS_FILE, self.statistics)
     
+    def save_state(self):
+        self.runtime_state["recent_keys"] = list(self.processed)
+        self._save_json(STATE_FILE, self.runtime_state)
+    
+    def save_last_seen(self):
+        self._save_json(LAST_SEEN_FILE, self.last_seen)
+    
+    def save_inactive(self):
+        self._save_json(INACTIVE_FILE, self.inactive)
+    
+    def save_topics(self):
+        self._save_json(TOPICS_FILE, self.user_topics)
+    
+    def save_assignments(self):
+        self._save_json(ASSIGNMENTS_FILE, self.assignments)
+    
+    def save_outbox(self):
+        self._save_json(OUTBOX_FILE, self.outbox)
+    
+    def save_history(self):
+        self.history.save(HISTORY_FILE)
+    
+    def mark_dirty(self, *names: str):
+        """标记数据待落盘, 由定时任务或停机时统一写入"""
+        self._dirty.update(names)
+    
+    def flush(self):
+        """写入所有脏数据"""
+        dirty, self._dirty = self._dirty, set()
+        for name in dirty:
+            getattr(self, f"save_{name}")()
+    
+    def flush_all(self):
+        """写入全部数据 (停机时使用)"""
+        self._dirty.clear()
+        self.save_mapping()
+        self.save_whitelist()
+        self.save_blacklist()
+        self.save_pending()
+        self.save_stats()
+        self.save_state()
+        self.save_last_seen()
+        self.save_inactive()
+        self.save_topics()
+        self.save_assignments()
+        self.save_outbox()
+        self.save_history()
+    
+    def record_history(self, user_id: int, direction: str, message):
+        self.history.add(user_id, direction, message_kind(message),
+                         message_preview(message, HISTORY_PREVIEW_LEN))
+        self.mark_dirty("history")
+    
+    # === 活跃索引 ===
+    def _rebuild_seen_index(self):
+        self._seen_by_day = {}
+        for user_id, ts in self.last_seen.items():
+            self._seen_by_day.setdefault(int(ts // 86400), set()).add(user_id)
+    
+    def touch(self, user_id: int):
+        """记录用户活跃, O(1); 同一天内只更新时间戳"""
+        now = int(time.time())
+        old = self.last_seen.get(user_id)
+        self.last_seen[user_id] = now
+        self.mark_dirty("last_seen")
+        # 用户主动发消息, 说明又可以收到消息了
+        if self.inactive.pop(user_id, None):
+            self.mark_dirty("inactive")
+        
+        old_day, new_day = (None if old is None else old // 86400), now // 86400
+        if old_day != new_day:
+            if old_day is not None:
+                bucket = self._seen_by_day.get(old_day)
+                if bucket:
+                    bucket.discard(user_id)
+                    if not bucket:
+                        del self._seen_by_day[old_day]
+            self._seen_by_day.setdefault(new_day, set()).add(user_id)
+    
+    def active_since(self, days: int) -> set:
+        """最近 days 天内活跃过的用户 (按天分桶的范围查询, 不扫描全部用户)"""
+        today = int(time.time()) // 86400
+        result = set()
+        for day in range(today - days + 1, today + 1):
+            result |= self._seen_by_day.get(day, set())
+        return result
+    
     # === 业务方法 ===
     def add_to_whitelist(self, user_id: int):
         self.whitelist.add(user_id)
@@ -148,10 +550,80 @@ class DataManager:
         self.save_whitelist()
         self.save_pending()
     
+    def bulk_add(self, list_name: str, user_ids):
+        """批量加入黑/白名单 (不落盘, 由调用方在结束后统一保存)"""
+        user_ids = set(user_ids)
+        if list_name == "black":
+            self.blacklist.update(user_ids)
+            self.whitelist.difference_update(user_ids)
+        else:
+            self.whitelist.update(user_ids)
+            self.blacklist.difference_update(user_ids)
+        for user_id in user_ids:
+            self.pending_verify.pop(user_id, None)
+    
     def remove_from_blacklist(self, user_id: int):
         self.blacklist.discard(user_id)
         self.save_blacklist()
     
+    def remove_from_whitelist(self, user_id: int):
+        self.whitelist.discard(user_id)
+        self.save_whitelist()
+    
+    # === 多客服 ===
+    def operator_pool(self) -> list:
+        return [self.owner_id] + self.operators
+    
+    def is_operator(self, user_id: int) -> bool:
+        return user_id == self.owner_id or user_id in self.operators
+    
+    def assign(self, user_id: int, operator_id: int):
+        old = self.assignments.get(user_id)
+        if old is not None:
+            self._operator_load[old] -= 1
+        self.assignments[user_id] = operator_id
+        self._operator_load[operator_id] += 1
+        self.mark_dirty("assignments")
+    
+    def operator_for(self, user_id: int) -> int:
+        """会话的负责客服: 已分配则沿用 (粘性), 否则按策略分配"""
+        if not self.operators:
+            return self.owner_id
+        operator_id = self.assignments.get(user_id)
+        pool = self.operator_pool()
+        if operator_id in pool:
+            return operator_id
+        if ASSIGN_STRATEGY == "round_robin":
+            operator_id = pool[self._round_robin % len(pool)]
+            self._round_robin += 1
+        else:
+            operator_id = min(pool, key=lambda op: self._operator_load[op])
+        self.assign(user_id, operator_id)
+        return operator_id
+    
+    def count_operator(self, operator_id: int, field: str, amount: int = 1):
+        """按客服累计统计 (forwarded / replies)"""
+        per_operator = self.statistics.setdefault("operators", {})
+        entry = per_operator.setdefault(str(operator_id), {"forwarded": 0, "replies": 0})
+        entry[field] += amount
+        self.mark_dirty("stats")
+    
+    def set_user_topic(self, user_id: int, thread_id: int):
+        old = self.user_topics.pop(user_id, None)
+        self.topic_users.pop(old, None)
+        if thread_id:
+            self.user_topics[user_id] = thread_id
+            self.topic_users[thread_id] = user_id
+        self.save_topics()
+    
+    def mark_inactive(self, user_id: int, reason: str):
+        """标记用户永久不可达, 后续群发和回复将跳过"""
+        self.inactive[user_id] = {"reason": reason, "since": datetime.now().isoformat()}
+        self.mark_dirty("inactive")
+    
+    def is_reachable(self, user_id: int) -> bool:
+        return user_id not in self.inactive
+    
     def is_allowed(self, user_id: int) -> bool:
         """检查用户是否允许访问"""
         return user_id == self.owner_id or user_id in self.whitelist
@@ -177,6 +649,10 @@ class VerificationSystem:
     @staticmethod
     async def start_verification(update: Update, user_id: int):
         """发起验证"""
+        if VERIFY_MODE == "buttons":
+            await ButtonVerification.start(update, user_id)
+            return
+        
         a, b, answer = VerificationSystem.generate_challenge()
         dm.pending_verify[user_id] = {"answer": answer, "attempts": 0}
         dm.save_pending()
@@ -234,37 +710,251 @@ class VerificationSystem:
         )
         return False
 
-# ==================== 权限装饰器 ====================
-def require_auth(func):
-    """统一权限验证装饰器"""
-    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        user_id = update.effective_user.id
+class ButtonVerification:
+    """
+    无状态按钮验证
+    callback_data: v|a|b|过期时间|已错次数|选项|签名
+    签名绑定 用户ID/题目/过期时间/次数, 服务器无需保存题目, 通过或最终失败前不写盘
+    """
+    
+    # 失败次数与未完成题目的过期时间仅保存在内存 (有上限), 防止反复发消息刷新题目来重置次数
+    strikes = OrderedDict()
+    outstanding = OrderedDict()
+    
+    @staticmethod
+    def _remember(cache: OrderedDict, user_id: int, value: int):
+        cache[user_id] = value
+        cache.move_to_end(user_id)
+        while len(cache) > VERIFY_STRIKE_CACHE:
+            cache.popitem(last=False)
+    
+    @staticmethod
+    def _forget(user_id: int):
+        ButtonVerification.strikes.pop(user_id, None)
+        ButtonVerification.outstanding.pop(user_id, None)
+    
+    @staticmethod
+    def _sign(user_id: int, a: int, b: int, expires: int, attempt: int) -> str:
+        msg = f"{user_id}:{a}:{b}:{expires}:{attempt}".encode()
+        digest = hmac.new(dm.verify_secret, msg, hashlib.sha256).digest()[:12]
+        return base64.urlsafe_b64encode(digest).decode()
+    
+    @staticmethod
+    def build_challenge(user_id: int, attempt: int):
+        """生成一道选择题: 返回 (题目文本, 键盘)"""
+        a, b, answer = VerificationSystem.generate_challenge()
+        expires = int(time.time()) + VERIFY_TTL
+        sig = ButtonVerification._sign(user_id, a, b, expires, attempt)
+        ButtonVerification._remember(ButtonVerification.outstanding, user_id, expires)
+        
+        # 干扰项与答案按同一分布抽取 (另出的题目的和), 不围绕答案, 选项本身不泄露答案
+        choices = {answer}
+        while len(choices) < VERIFY_CHOICES:
+            choices.add(VerificationSystem.generate_challenge()[2])
+        choices = sorted(choices)
+        
+        buttons = [InlineKeyboardButton(str(c), callback_data=f"v|{a}|{b}|{expires}|{attempt}|{c}|{sig}")
+                   for c in choices]
+        keyboard = InlineKeyboardMarkup([buttons[i:i + VERIFY_CHOICE_COLUMNS]
+                                         for i in range(0, len(buttons), VERIFY_CHOICE_COLUMNS)])
+        text = (
+            "🛡️ <b>安全验证</b>\n\n"
+            "检测到新用户，请选择正确答案：\n\n"
+            f"👉 <b>{a} + {b} = ?</b>\n\n"
+            f"还剩 <b>{VERIFY_BUTTON_ATTEMPTS - attempt}</b> 次机会"
+        )
+        return text, keyboard
+    
+    @staticmethod
+    async def start(update: Update, user_id: int):
+        # 上一道题仍未过期时不出新题, 否则每条消息都会多出一组可猜的按钮
+        if ButtonVerification.outstanding.get(user_id, 0) > time.time():
+            await update.message.reply_html("🛡️ 请先完成上方的验证题目")
+            return
+        attempt = ButtonVerification.strikes.get(user_id, 0)
+        text, keyboard = ButtonVerification.build_challenge(user_id, attempt)
+        await update.message.reply_html(text, reply_markup=keyboard)
+    
+    @staticmethod
+    async def handle_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """处理选择题按钮回调"""
+        query = update.callback_query
+        user_id = query.from_user.id
+        
+        try:
+            _, a, b, expires, attempt, choice, sig = query.data.split("|")
+            a, b, expires, attempt, choice = int(a), int(b), int(expires), int(attempt), int(choice)
+        except ValueError:
+            await query.answer()
+            return
+        
+        # 签名校验, 并且只接受当前消息上仍然存在的按钮 (旧题目的按钮不能重放)
+        current = [btn.callback_data for row in query.message.reply_markup.inline_keyboard
+                   for btn in row] if query.message and query.message.reply_markup else []
+        valid = hmac.compare_digest(sig, ButtonVerification._sign(user_id, a, b, expires, attempt))
+        if not valid or query.data not in current:
+            await query.answer("⚠️ 验证已失效", show_alert=True)
+            return
+        
+        if user_id in dm.whitelist:
+            await query.answer()
+            return
+        
+        # 次数以服务器记录为准, 旧消息上的按钮不能带着较小的次数继续作答
+        attempt = max(attempt, ButtonVerification.strikes.get(user_id, 0))
         
-        # 黑名单检查
-        if dm.is_blocked(user_id):
+        if time.time() > expires:
+            text, keyboard = ButtonVerification.build_challenge(user_id, attempt)
+            await query.answer("⌛ 题目已过期，已更换新题目")
+            await query.edit_message_text(text, reply_markup=keyboard, parse_mode=ParseMode.HTML)
             return
         
-        # 白名单/主人检查
-        if dm.is_allowed(user_id):
-            return await func(update, context)
+        if choice == a + b:
+            ButtonVerification._forget(user_id)
+            dm.add_to_whitelist(user_id)
+            await query.answer("✅ 验证通过")
+            await query.edit_message_text(
+                "✅ <b>验证通过！</b>\n\n已获得使用权限，请重新发送 /start",
+                parse_mode=ParseMode.HTML
+            )
+            logger.info(f"用户 {user_id} 按钮验证通过")
+            return
         
-        # 验证中检查
-        if user_id in dm.pending_verify:
-            text = update.message.text if update.message else None
-            if text:
-                await VerificationSystem.check_answer(update, user_id, text)
+        attempt += 1
+        if attempt >= VERIFY_BUTTON_ATTEMPTS:
+            ButtonVerification._forget(user_id)
+            dm.add_to_blacklist(user_id)
+            dm.statistics["blocked_attempts"] += 1
+            dm.save_stats()
+            await query.answer()
+            await query.edit_message_text(
+                "❌ <b>验证失败</b>\n\n机会已用完，您已被永久拉黑。",
+                parse_mode=ParseMode.HTML
+            )
+            logger.info(f"用户 {user_id} 按钮验证失败，已拉黑")
             return
         
-        # 发起新验证
-        await VerificationSystem.start_verification(update, user_id)
+        ButtonVerification._remember(ButtonVerification.strikes, user_id, attempt)
+        text, keyboard = ButtonVerification.build_challenge(user_id, attempt)
+        await query.answer("⚠️ 回答错误")
+        await query.edit_message_text(text, reply_markup=keyboard, parse_mode=ParseMode.HTML)
+
+# ==================== 访问控制中间件 ====================
+class Access:
+    """一次更新的访问控制结果"""
+    
+    def __init__(self, user_id=None):
+        self.user_id = user_id
+        self.role = None        # owner / operator / whitelisted / pending / blocked / new
+        self.timings = {}       # 各阶段耗时(秒)
+
+class BotContext(CallbackContext):
+    """附带访问控制结果的上下文, 同一更新的各处理器组共享"""
+    
+    def __init__(self, application, chat_id=None, user_id=None):
+        super().__init__(application, chat_id, user_id)
+        self.access = None
+
+def _is_verify_callback(update: Update) -> bool:
+    query = update.callback_query
+    return bool(query and query.data and query.data.startswith("v|"))
+
+# 分类阶段: 按顺序执行, 第一个给出角色的阶段决定结果
+# 主人/客服先于黑名单判定: 其ID误入黑名单 (如 /import 共享名单) 时仍可使用 /unban 等命令
+ACCESS_STAGES = [
+    ("owner", lambda uid: "owner" if uid == dm.owner_id else None),
+    ("operator", lambda uid: "operator" if uid in dm.operators else None),
+    ("blocked", lambda uid: "blocked" if dm.is_blocked(uid) else None),
+    ("whitelist", lambda uid: "whitelisted" if uid in dm.whitelist else None),
+    ("pending", lambda uid: "pending" if uid in dm.pending_verify else None),
+]
+
+# 各阶段累计耗时: {阶段: [次数, 总秒数]}, 供统计和性能分析使用
+pipeline_timings = {}
+
+def _record_timing(access: Access, stage: str, started: float):
+    elapsed = time.perf_counter() - started
+    access.timings[stage] = elapsed
+    entry = pipeline_timings.setdefault(stage, [0, 0.0])
+    entry[0] += 1
+    entry[1] += elapsed
+
+async def access_middleware(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    每个更新只执行一次的访问控制 (处理器组 -1)
+    分类发送者并写入 context.access; 拉黑/待验证/新用户在此终止, 不再进入业务处理器
+    """
+    user = update.effective_user
+    access = Access(user.id if user else None)
+    context.access = access
+    if user is None:
+        return
+    
+    for stage, classify in ACCESS_STAGES:
+        started = time.perf_counter()
+        access.role = classify(user.id)
+        _record_timing(access, stage, started)
+        if access.role:
+            break
+    else:
+        access.role = "new"
+    
+    # 群组 (如话题模式的论坛群) 里只处理主人, 其他成员不触发验证
+    chat = update.effective_chat
+    if chat and chat.type != chat.PRIVATE and access.role != "owner":
+        raise ApplicationHandlerStop
+    
+    if access.role in ("owner", "operator", "whitelisted"):
+        if access.role == "whitelisted":
+            dm.touch(user.id)
         return
     
+    if access.role == "blocked":
+        raise ApplicationHandlerStop
+    
+    # 陌生人的验证按钮交给 ButtonVerification 处理
+    if _is_verify_callback(update):
+        return
+    
+    started = time.perf_counter()
+    if update.message:
+        if access.role == "pending":
+            if update.message.text:
+                await VerificationSystem.check_answer(update, user.id, update.message.text)
+        else:
+            await VerificationSystem.start_verification(update, user.id)
+    _record_timing(access, "verify", started)
+    raise ApplicationHandlerStop
+
+def format_pipeline_timings() -> str:
+    """中间件各阶段平均耗时 (用于 /stats)"""
+    if not pipeline_timings:
+        return ""
+    parts = [f"{stage} <code>{total / count * 1e6:.0f}µs</code>"
+             for stage, (count, total) in pipeline_timings.items()]
+    return "\n\n🧭 <b>访问控制耗时</b>\n" + " · ".join(parts)
+
+# ==================== 权限装饰器 ====================
+def require_auth(func):
+    """仅主人、客服和白名单用户 (由 access_middleware 判定)"""
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if context.access.role not in ("owner", "operator", "whitelisted"):
+            return
+        return await func(update, context)
+    return wrapper
+
+def operator_only(func):
+    """主人和客服可用"""
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if context.access.role not in ("owner", "operator"):
+            return
+        return await func(update, context)
     return wrapper
 
 def owner_only(func):
     """仅主人可用"""
     async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        if update.effective_user.id != dm.owner_id:
+        if context.access.role != "owner":
             return
         return await func(update, context)
     return wrapper
@@ -283,6 +973,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "/help - 帮助信息\n"
             "/stats - 查看统计\n"
             "/banlist - 黑名单管理\n"
+            "/whitelist - 白名单管理\n"
             "/broadcast - 群发消息\n"
             "/clear - 清理缓存"
         )
@@ -304,8 +995,16 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "<b>管理命令：</b>\n"
             "• /stats - 运行统计\n"
             "• /banlist - 黑名单列表\n"
+            "• /whitelist - 白名单列表\n"
             "• /unban [用户ID] - 解除拉黑\n"
-            "• /broadcast [消息] - 群发给所有白名单用户\n"
+            "• /broadcast [active=天数] [消息] - 群发给白名单用户 (或回复任意消息群发)\n"
+            "• /import [black|white] - 回复文件批量导入名单\n"
+            "• /export - 导出黑/白名单\n"
+            "• /profile [秒数] [flame] - 采集性能报告\n"
+            "• /memstats [trace on|off] - 内存占用报告\n"
+            "• /record [on|off] - 录制匿名流量 (用于 replay_traffic.py 回放)\n"
+            "• /filter [reload|add|del|test] - 内容过滤规则\n"
+            "• /assign [用户ID] [客服ID] - 分配会话\n"
             "• /clear - 清理消息映射缓存\n\n"
             "<b>快捷操作：</b>\n"
             "转发消息后会显示控制面板，可一键拉黑"
@@ -327,27 +1026,85 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"📨 转发消息: <b>{stats.get('total_messages', 0)}</b>\n"
         f"💬 回复消息: <b>{stats.get('total_replies', 0)}</b>\n"
         f"✅ 已验证用户: <b>{stats.get('verified_users', 0)}</b>\n"
-        f"🚫 拦截次数: <b>{stats.get('blocked_attempts', 0)}</b>\n\n"
+        f"🚫 拦截次数: <b>{stats.get('blocked_attempts', 0)}</b>\n"
+        f"🛡️ 内容过滤: <b>{stats.get('filtered_messages', 0)}</b>\n"
+        f"🔁 重复抑制: <b>{stats.get('suppressed_repeats', 0)}</b>\n\n"
         f"📝 当前映射: <b>{len(dm.user_mapping)}</b> 条\n"
         f"👥 白名单: <b>{len(dm.whitelist)}</b> 人\n"
-        f"🚷 黑名单: <b>{len(dm.blacklist)}</b> 人"
+        f"🚷 黑名单: <b>{len(dm.blacklist)}</b> 人\n"
+        f"💤 不可达: <b>{len(dm.inactive)}</b> 人"
+        + format_operator_stats()
+        + format_lag_stats()
+        + format_pipeline_timings()
     )
 
-@owner_only
-async def banlist_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """查看黑名单"""
-    if not dm.blacklist:
-        await update.message.reply_html("🚷 黑名单为空")
-        return
+def format_operator_stats() -> str:
+    """按客服的统计 (用于 /stats)"""
+    if not dm.operators:
+        return ""
+    per_operator = dm.statistics.get("operators", {})
+    lines = ["\n\n🧑‍💼 <b>客服</b>"]
+    for operator_id in dm.operator_pool():
+        entry = per_operator.get(str(operator_id), {})
+        lines.append(
+            f"<code>{operator_id}</code> 会话 {dm._operator_load[operator_id]} · "
+            f"转入 {entry.get('forwarded', 0)} · 回复 {entry.get('replies', 0)}"
+        )
+    return "\n".join(lines)
+
+def format_lag_stats() -> str:
+    """事件循环延迟分位数 (用于 /stats)"""
+    lag = loop_monitor.percentiles()
+    if not lag:
+        return ""
+    return (
+        "\n\n🐢 <b>事件循环延迟</b>\n"
+        f"p50 <code>{lag['p50']:.0f}ms</code> · p95 <code>{lag['p95']:.0f}ms</code> · "
+        f"p99 <code>{lag['p99']:.0f}ms</code> · max <code>{lag['max']:.0f}ms</code>"
+    )
+
+LIST_KINDS = {
+    "b": ("🚷", "黑名单", "✅ 解封"),
+    "w": ("👥", "白名单", "➖ 移出"),
+}
+
+def build_list_page(kind: str, start=None):
+    """渲染黑/白名单的一页: 返回 (文本, 键盘)"""
+    ids = dm.blacklist if kind == "b" else dm.whitelist
+    icon, title, action_text = LIST_KINDS[kind]
+    items, prev_start, next_start = ids.page(start)
     
-    lines = [f"• <code>{uid}</code>" for uid in list(dm.blacklist)[:20]]
-    text = "🚷 <b>黑名单</b>\n\n" + "\n".join(lines)
+    if not items:
+        return f"{icon} {title}为空", None
     
-    if len(dm.blacklist) > 20:
-        text += f"\n\n... 共 {len(dm.blacklist)} 人"
+    rows = [
+        [InlineKeyboardButton(f"{action_text} {uid}",
+                              callback_data=f"lsdel:{kind}:{uid}:{items[0]}")]
+        for uid in items
+    ]
+    nav = []
+    if prev_start is not None:
+        nav.append(InlineKeyboardButton("◀", callback_data=f"lspage:{kind}:{prev_start}"))
+    if next_start is not None:
+        nav.append(InlineKeyboardButton("▶", callback_data=f"lspage:{kind}:{next_start}"))
+    if nav:
+        rows.append(nav)
     
-    text += "\n\n使用 /unban [用户ID] 解封"
-    await update.message.reply_html(text)
+    lines = [f"• <code>{uid}</code>" for uid in items]
+    text = f"{icon} <b>{title}</b> (共 {len(ids)} 人)\n\n" + "\n".join(lines)
+    return text, InlineKeyboardMarkup(rows)
+
+@owner_only
+async def banlist_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """查看黑名单"""
+    text, keyboard = build_list_page("b")
+    await update.message.reply_html(text, reply_markup=keyboard)
+
+@owner_only
+async def whitelist_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """查看白名单"""
+    text, keyboard = build_list_page("w")
+    await update.message.reply_html(text, reply_markup=keyboard)
 
 @owner_only
 async def unban_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -366,156 +1123,1454 @@ async def unban_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except ValueError:
         await update.message.reply_html("请输入有效的用户ID")
 
+class RateLimiter:
+    """异步令牌桶限速器, 遇到 429 时整体暂停"""
+    
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+    
+    async def wait(self):
+        async with self._lock:
+            now = asyncio.get_running_loop().time()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+    
+    def pause(self, seconds: float):
+        now = asyncio.get_running_loop().time()
+        self._next = max(self._next, now + seconds)
+
+# 发送失败分类 -> 说明
+# transient 可重试; rejected 是这条消息本身被拒绝 (如 "Message can't be copied"), 不重试也不影响用户状态
+SEND_FAILURE_KINDS = {
+    "blocked": "已拉黑机器人",
+    "not_found": "会话不存在",
+    "deactivated": "账号已注销",
+    "rejected": "消息被拒绝",
+    "transient": "临时错误",
+}
+
+# 这几类说明用户永久不可达, 需标记到 dm.inactive
+UNREACHABLE_KINDS = {"blocked", "not_found", "deactivated"}
+
+def classify_send_error(error: TelegramError) -> str:
+    """将发送失败归类为 blocked / not_found / deactivated / rejected / transient"""
+    text = str(error).lower()
+    if isinstance(error, Forbidden):
+        if "deactivated" in text:
+            return "deactivated"
+        return "blocked"
+    if isinstance(error, BadRequest):
+        return "not_found" if "chat not found" in text else "rejected"
+    # 只有网络故障、超时、限流与 5xx (PTB 均抛出 NetworkError) 值得重试
+    if isinstance(error, (NetworkError, TimedOut, RetryAfter)):
+        return "transient"
+    return "rejected"
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    """兼容 retry_after 为 int 或 timedelta 的不同版本"""
+    retry = error.retry_after
+    return retry.total_seconds() if hasattr(retry, "total_seconds") else float(retry)
+
+async def call_with_retry(make_call):
+    """执行一次 API 调用, 遇到限流按服务器要求等待后重试 (make_call 每次返回新的协程)"""
+    for _ in range(BROADCAST_MAX_RETRIES - 1):
+        try:
+            return await make_call()
+        except RetryAfter as e:
+            await asyncio.sleep(retry_after_seconds(e))
+    return await make_call()
+
+async def fan_out(user_ids, send, status_msg=None) -> dict:
+    """
+    并发限速地向多个用户发送
+    send: 接收 user_id 的协程函数
+    永久不可达的用户会被跳过, 新发现的会被标记到 dm.inactive
+    返回: {"success": int, "failed": int, "skipped": int, "pruned": {user_id: 原因}}
+    """
+    all_ids = list(user_ids)
+    user_ids = [uid for uid in all_ids if dm.is_reachable(uid)]
+    limiter = RateLimiter(BROADCAST_RATE)
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    result = {"success": 0, "failed": 0, "skipped": len(all_ids) - len(user_ids), "pruned": {}}
+    
+    async def deliver(user_id: int):
+        async with semaphore:
+            for _ in range(BROADCAST_MAX_RETRIES):
+                await limiter.wait()
+                try:
+                    await send(user_id)
+                    result["success"] += 1
+                    return
+                except RetryAfter as e:
+                    limiter.pause(retry_after_seconds(e))
+                except TelegramError as e:
+                    kind = classify_send_error(e)
+                    logger.debug(f"群发给 {user_id} 失败 ({kind}): {e}")
+                    if kind in UNREACHABLE_KINDS:
+                        dm.mark_inactive(user_id, kind)
+                        result["pruned"][user_id] = kind
+                    break
+            result["failed"] += 1
+    
+    async def report_progress():
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            done = result["success"] + result["failed"]
+            try:
+                await status_msg.edit_text(f"📤 正在发送... {done}/{len(user_ids)}")
+            except TelegramError:
+                pass
+    
+    progress = asyncio.create_task(report_progress()) if status_msg else None
+    try:
+        await asyncio.gather(*(deliver(uid) for uid in user_ids))
+    finally:
+        if progress:
+            progress.cancel()
+    return result
+
+# 主人最近发送的相册: media_group_id -> [message_id, ...]
+owner_albums = {}
+
+def remember_owner_album(message):
+    """记录主人发送的相册消息, 群发时整组复制"""
+    album = owner_albums.setdefault(message.media_group_id, [])
+    album.append(message.message_id)
+    while len(owner_albums) > ALBUM_CACHE_SIZE:
+        owner_albums.pop(next(iter(owner_albums)))
+
 @owner_only
 async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """群发消息给所有白名单用户"""
-    if not context.args:
+    """群发消息给所有白名单用户 (文本参数, 或回复任意消息/相册)"""
+    source = update.message.reply_to_message
+    args = list(context.args)
+    
+    # 可选筛选: active=N 仅发送给最近 N 天活跃的用户
+    active_days = None
+    if args and args[0].startswith("active="):
+        try:
+            active_days = int(args.pop(0).split("=", 1)[1])
+        except ValueError:
+            await update.message.reply_html("请输入有效的天数, 如 active=30")
+            return
+    
+    if not args and not source:
         await update.message.reply_html(
             "📢 <b>群发功能</b>\n\n"
-            "用法: /broadcast [消息内容]\n"
+            "用法: /broadcast [active=天数] [消息内容]\n"
+            "或回复任意消息 (图片/视频/文件/相册) 发送 /broadcast [active=天数]\n"
             f"将发送给 {len(dm.whitelist)} 位白名单用户"
         )
         return
     
-    message = ' '.join(context.args)
-    success, failed = 0, 0
-    
-    status_msg = await update.message.reply_html("📤 正在发送...")
+    # 处理器以 block=False 注册, 群发期间其他更新照常处理; 先取名单快照, 避免遍历中被修改
+    if active_days is None:
+        targets = list(dm.whitelist)
+    else:
+        targets = [uid for uid in dm.active_since(active_days) if uid in dm.whitelist]
     
-    for user_id in dm.whitelist:
-        try:
+    if source:
+        # copy_message 在服务端复用 file_id, 媒体只需上传一次
+        album = sorted(owner_albums.get(source.media_group_id, [])) if source.media_group_id else []
+        if len(album) > 1:
+            async def send(user_id):
+                await context.bot.copy_messages(
+                    chat_id=user_id, from_chat_id=source.chat_id, message_ids=album
+                )
+        else:
+            async def send(user_id):
+                await context.bot.copy_message(
+                    chat_id=user_id, from_chat_id=source.chat_id, message_id=source.message_id
+                )
+    else:
+        message = ' '.join(args)
+        
+        async def send(user_id):
             await context.bot.send_message(
                 chat_id=user_id,
                 text=f"📢 <b>系统通知</b>\n\n{message}",
                 parse_mode=ParseMode.HTML
             )
-            success += 1
-        except:
-            failed += 1
+    
+    status_msg = await update.message.reply_html(f"📤 正在发送给 {len(targets)} 位用户...")
+    result = await fan_out(targets, send, status_msg)
     
     await status_msg.edit_text(
         f"📢 <b>群发完成</b>\n\n"
-        f"✅ 成功: {success}\n"
-        f"❌ 失败: {failed}",
+        f"✅ 成功: {result['success']}\n"
+        f"❌ 失败: {result['failed']}\n"
+        f"💤 跳过不可达: {result['skipped']}"
+        + format_pruned_report(result["pruned"]),
         parse_mode=ParseMode.HTML
     )
 
-@owner_only
-async def clear_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """清除映射缓存"""
-    count = len(dm.user_mapping)
-    dm.user_mapping.clear()
-    dm.save_mapping()
-    await update.message.reply_html(f"🗑️ 已清除 {count} 条消息映射")
+def format_pruned_report(pruned: dict, limit: int = 20) -> str:
+    """本次新标记为不可达的用户报告"""
+    if not pruned:
+        return ""
+    by_kind = Counter(pruned.values())
+    lines = [f"\n\n🧹 <b>新标记不可达 {len(pruned)} 人</b>"]
+    lines += [f"• {SEND_FAILURE_KINDS[kind]}: {count}" for kind, count in by_kind.items()]
+    lines += [f"<code>{uid}</code> {SEND_FAILURE_KINDS[kind]}"
+              for uid, kind in list(pruned.items())[:limit]]
+    if len(pruned) > limit:
+        lines.append(f"... 等 {len(pruned)} 人")
+    return "\n".join(lines)
 
-# ==================== 消息处理器 ====================
-@require_auth
-async def forward_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """转发用户消息给主人"""
-    user = update.effective_user
+def _parse_list_line(line: str, default_list: str):
+    """解析导入文件的一行 (CSV 或 NDJSON), 返回 (名单, 用户ID) 或 None"""
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        if line.startswith("{"):
+            obj = json.loads(line)
+            user_id = obj.get("user_id", obj.get("id"))
+            list_name = obj.get("list", default_list)
+        else:
+            row = next(csv.reader([line]))
+            user_id = row[0]
+            list_name = row[1].strip() if len(row) > 1 and row[1].strip() else default_list
+        if list_name not in ("black", "white"):
+            return None
+        return list_name, int(user_id)
+    except (ValueError, TypeError, AttributeError, StopIteration):
+        return None
+
+@owner_only
+async def import_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """批量导入黑/白名单: 回复一个 CSV/NDJSON (可 .gz) 文件"""
     message = update.message
+    default_list = context.args[0] if context.args else "black"
+    document = message.reply_to_message.document if message.reply_to_message else None
     
-    if user.id == dm.owner_id:
-        if not message.reply_to_message:
-            await message.reply_html("💡 请回复转发的消息来回复用户")
+    if default_list not in ("black", "white") or not document:
+        await message.reply_html(
+            "📥 <b>批量导入</b>\n\n"
+            "用法: 回复一个 CSV / NDJSON 文件 (支持 .gz) 并发送\n"
+            "/import [black|white]\n\n"
+            "CSV: <code>用户ID[,black|white]</code>\n"
+            "NDJSON: <code>{\"user_id\": 123, \"list\": \"black\"}</code>"
+        )
         return
     
-    # 构建信息头
-    username = f"@{user.username}" if user.username else "无"
-    info_text = (
-        f"📩 <b>新消息</b>\n\n"
-        f"👤 {user.mention_html()}\n"
-        f"🆔 <code>{user.id}</code>\n"
-        f"🔗 {username}\n\n"
-        f"👇 回复下方消息以回复该用户"
-    )
+    status_msg = await message.reply_html("📥 正在下载文件...")
+    fd, path = tempfile.mkstemp(suffix=".import")
+    os.close(fd)
     
     try:
-        await context.bot.send_message(
-            chat_id=dm.owner_id, 
-            text=info_text, 
-            parse_mode=ParseMode.HTML
-        )
+        tg_file = await context.bot.get_file(document.file_id)
+        await tg_file.download_to_drive(path)
         
-        forwarded = await message.forward(chat_id=dm.owner_id)
-        dm.user_mapping[forwarded.message_id] = user.id
-        dm.save_mapping()
-        
-        # 发送控制面板
-        keyboard = InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton("🚫 拉黑", callback_data=f"ban:{user.id}"),
-                InlineKeyboardButton("📋 用户信息", callback_data=f"info:{user.id}")
-            ]
-        ])
-        await context.bot.send_message(
-            chat_id=dm.owner_id,
-            text=f"⚙️ 操作面板 | 用户: <code>{user.id}</code>",
-            reply_markup=keyboard,
-            parse_mode=ParseMode.HTML
-        )
+        is_gzip = (document.file_name or "").endswith(".gz")
+        opener = gzip.open if is_gzip else open
+        counts = {"black": 0, "white": 0}
+        invalid = 0
+        lines = 0
+        last_progress = time.monotonic()
         
-        dm.statistics["total_messages"] += 1
-        dm.save_stats()
+        with opener(path, "rt", encoding="utf-8", errors="replace") as f:
+            while True:
+                chunk = [line for _, line in zip(range(IMPORT_CHUNK_SIZE), f)]
+                if not chunk:
+                    break
+                lines += len(chunk)
+                
+                batch = {"black": [], "white": []}
+                for line in chunk:
+                    if not line.strip():
+                        continue
+                    parsed = _parse_list_line(line, default_list)
+                    if parsed is None:
+                        invalid += 1
+                    else:
+                        batch[parsed[0]].append(parsed[1])
+                for list_name, user_ids in batch.items():
+                    if user_ids:
+                        dm.bulk_add(list_name, user_ids)
+                        counts[list_name] += len(user_ids)
+                
+                # 让出事件循环 (处理器以 block=False 注册, 导入期间其他更新照常处理)
+                await asyncio.sleep(0)
+                if time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+                    last_progress = time.monotonic()
+                    try:
+                        await status_msg.edit_text(f"📥 导入中... 已处理 {lines} 行")
+                    except TelegramError as e:
+                        logger.debug(f"导入进度更新失败: {e}")
         
-        await message.reply_html("✅ 已送达")
-        logger.info(f"转发消息: {user.id} -> 主人")
+        dm.save_blacklist()
+        dm.save_whitelist()
+        dm.save_pending()
         
-    except TelegramError as e:
-        logger.error(f"转发失败: {e}")
-        await message.reply_html("❌ 发送失败，请稍后重试")
+        await status_msg.edit_text(
+            "📥 <b>导入完成</b>\n\n"
+            f"🚷 黑名单: +{counts['black']}\n"
+            f"👥 白名单: +{counts['white']}\n"
+            f"⚠️ 无效行: {invalid}",
+            parse_mode=ParseMode.HTML
+        )
+        logger.info(f"批量导入完成: {counts}, 无效 {invalid} 行")
+    except (TelegramError, OSError) as e:
+        logger.error(f"批量导入失败: {e}")
+        await status_msg.edit_text(f"❌ 导入失败: {e}")
+    finally:
+        os.remove(path)
+
+def _write_export(path: str, lists: dict):
+    """将名单逐行写入 gzip 压缩的 NDJSON (在线程中执行)"""
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        for list_name, user_ids in lists.items():
+            for user_id in user_ids:
+                f.write(json.dumps({"user_id": user_id, "list": list_name}) + "\n")
 
 @owner_only
-async def reply_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """主人回复消息"""
-    message = update.message
-    replied_id = message.reply_to_message.message_id
-    target_user = dm.user_mapping.get(replied_id)
-    
-    if not target_user:
-        await message.reply_html("⚠️ 找不到原始用户记录")
-        return
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """导出黑/白名单为压缩 NDJSON 文件"""
+    lists = {"black": list(dm.blacklist), "white": list(dm.whitelist)}
+    fd, path = tempfile.mkstemp(suffix=".ndjson.gz")
+    os.close(fd)
     
     try:
-        await message.copy(chat_id=target_user)
-        dm.statistics["total_replies"] += 1
-        dm.save_stats()
-        await message.reply_html("✅ 已发送")
-        logger.info(f"回复消息: 主人 -> {target_user}")
-    except TelegramError as e:
-        error_msg = f"❌ 发送失败: <code>{e}</code>"
-        if "blocked" in str(e).lower():
-            error_msg += "\n\n该用户可能已拉黑机器人"
-        await message.reply_html(error_msg)
+        await asyncio.to_thread(_write_export, path, lists)
+        filename = f"moderation_lists_{datetime.now():%Y%m%d_%H%M%S}.ndjson.gz"
+        with open(path, "rb") as f:
+            await update.message.reply_document(
+                document=f,
+                filename=filename,
+                caption=f"📤 黑名单 {len(lists['black'])} 人, 白名单 {len(lists['white'])} 人"
+            )
+    except (TelegramError, OSError) as e:
+        logger.error(f"导出失败: {e}")
+        await update.message.reply_html(f"❌ 导出失败: <code>{e}</code>")
+    finally:
+        os.remove(path)
 
-# ==================== 回调处理器 ====================
-async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """处理按钮回调"""
-    query = update.callback_query
-    await query.answer()
+@owner_only
+async def clear_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """清除映射缓存"""
+    count = len(dm.user_mapping)
+    dm.user_mapping.clear()
+    dm.save_mapping()
+    await update.message.reply_html(f"🗑️ 已清除 {count} 条消息映射")
+
+# ==================== 摘要模式 ====================
+MEDIA_LABELS = [
+    ("photo", "[图片]"), ("video", "[视频]"), ("animation", "[动图]"),
+    ("sticker", "[贴纸]"), ("voice", "[语音]"), ("video_note", "[视频消息]"),
+    ("audio", "[音频]"), ("document", "[文件]"), ("location", "[位置]"),
+    ("contact", "[联系人]"), ("poll", "[投票]"),
+]
+
+def message_kind(message) -> str:
+    """消息类型: text 或媒体属性名"""
+    for attr, _ in MEDIA_LABELS:
+        if getattr(message, attr, None):
+            return attr
+    return "text" if message.text else "other"
+
+def message_preview(message, limit: int = DIGEST_PREVIEW_LEN) -> str:
+    """消息的简短预览: 文本/说明截断, 媒体显示类型标签"""
+    label = dict(MEDIA_LABELS).get(message_kind(message), "")
+    text = (message.text or message.caption or "").replace("\n", " ")
+    if len(text) > limit:
+        text = text[:limit] + "…"
+    return f"{label} {text}".strip() or "[消息]"
+
+class DigestBuffer:
+    """
+    高峰期的主人摘要: 窗口内的消息按用户汇总为一条摘要,
+    原消息按用户批量转发 (仍可回复), 替代每条消息的 信息头 + 转发 + 面板
+    暂存只在内存中, 转发成功后才给用户回执; 转发失败的消息转入发件箱重试
+    """
     
-    if query.from_user.id != dm.owner_id:
+    def __init__(self):
+        # {user_id: {"name": str, "chat_id": int, "messages": [(id, 预览, 是否积压)], "last": 最近一条实时消息}}
+        self.pending = {}
+        self._arrivals = deque()    # 最近一分钟的入站时间
+        self._bot = None
+        self._timer = None
+    
+    def note_inbound(self):
+        now = time.monotonic()
+        self._arrivals.append(now)
+        while self._arrivals and now - self._arrivals[0] > 60:
+            self._arrivals.popleft()
+    
+    @property
+    def active(self) -> bool:
+        if DIGEST_MODE == "on":
+            return True
+        if DIGEST_MODE == "auto":
+            return len(self._arrivals) > DIGEST_RATE_THRESHOLD
+        return False
+    
+    def add(self, bot, user, message):
+        entry = self.pending.setdefault(user.id, {
+            "name": user.mention_html(), "chat_id": message.chat_id, "messages": [], "last": None
+        })
+        entry["messages"].append((message.message_id, message_preview(message), catchup.active))
+        if not catchup.active:
+            entry["last"] = message
+        self._bot = bot
+        if self._timer is None:
+            self._timer = start_background(self._flush_later())
+    
+    async def _flush_later(self):
+        await asyncio.sleep(DIGEST_WINDOW)
+        self._timer = None
+        await self.flush()
+    
+    async def flush(self):
+        """按负责的客服分组, 每组发送一条摘要, 然后按用户批量转发原消息"""
+        pending, self.pending = self.pending, {}
+        if not pending or self._bot is None:
+            return
+        groups = {}
+        for user_id, entry in pending.items():
+            groups.setdefault(dm.operator_for(user_id), {})[user_id] = entry
+        for chat_id, entries in groups.items():
+            await self._flush_to(self._bot, chat_id, entries)
+        dm.mark_dirty("mapping")
+    
+    async def _flush_to(self, bot, chat_id: int, pending: dict):
+        header_cache.reset(chat_id)
+        # 映射表只记录主人会话; 其他客服 (或无状态路由) 在每个用户的消息后附操作面板, 回复面板即可
+        with_panel = chat_id != dm.owner_id or ROUTING_MODE == "stateless"
+        
+        total = sum(len(entry["messages"]) for entry in pending.values())
+        lines = [f"📬 <b>消息摘要</b> | {total} 条 / {len(pending)} 人\n"]
+        for user_id, entry in list(pending.items())[:DIGEST_MAX_USERS]:
+            previews = " / ".join(html.escape(p) for _, p, _ in entry["messages"][:3])
+            lines.append(f"👤 {entry['name']} <code>{user_id}</code> ×{len(entry['messages'])}\n   {previews}")
+        if len(pending) > DIGEST_MAX_USERS:
+            lines.append(f"... 另有 {len(pending) - DIGEST_MAX_USERS} 人")
+        lines.append("\n👇 原消息已按用户转发, " + ("回复其后的操作面板即可回复" if with_panel else "可直接回复"))
+        
+        try:
+            await call_with_retry(lambda: bot.send_message(
+                chat_id=chat_id, text="\n".join(lines), parse_mode=ParseMode.HTML
+            ))
+        except TelegramError as e:
+            logger.error(f"摘要发送失败: {e}")
+        
+        for user_id, entry in pending.items():
+            messages = entry["messages"]
+            delivered_live = delivered_backlog = 0
+            # forward_messages 每次最多 100 条
+            for i in range(0, len(messages), 100):
+                batch = messages[i:i + 100]
+                try:
+                    forwarded = await call_with_retry(lambda: bot.forward_messages(
+                        chat_id=chat_id, from_chat_id=entry["chat_id"],
+                        message_ids=[mid for mid, _, _ in batch]
+                    ))
+                except TelegramError as e:
+                    # 逐条转入发件箱, 由发件箱重试并把结果通知用户
+                    logger.error(f"摘要批量转发失败 ({user_id}), 转入发件箱: {e}")
+                    for mid, _, _ in batch:
+                        outbox.enqueue(chat_id, entry["chat_id"], mid,
+                                       kind="copy" if with_panel else "forward",
+                                       panel_user=user_id if with_panel else None,
+                                       map_user=user_id, notify=(entry["chat_id"], mid))
+                    continue
+                if chat_id == dm.owner_id:
+                    for msg_id in forwarded:
+                        dm.user_mapping[msg_id.message_id] = user_id
+                delivered_backlog += sum(1 for _, _, backlog in batch if backlog)
+                delivered_live += sum(1 for _, _, backlog in batch if not backlog)
+            
+            delivered = delivered_live + delivered_backlog
+            if not delivered:
+                continue
+            if dm.operators:
+                dm.count_operator(chat_id, "forwarded", delivered)
+            if with_panel:
+                try:
+                    await call_with_retry(lambda: bot.send_message(
+                        chat_id=chat_id, text=f"⚙️ 操作面板 | 用户: <code>{user_id}</code>",
+                        reply_markup=build_panel_keyboard(user_id), parse_mode=ParseMode.HTML
+                    ))
+                except TelegramError as e:
+                    logger.warning(f"摘要操作面板发送失败 ({user_id}): {e}")
+            if delivered_backlog:
+                catchup.acks[user_id] += delivered_backlog
+            if delivered_live and entry["last"]:
+                await reply_notice(
+                    entry["last"], "✅ 已送达" if delivered_live == 1 else f"✅ {delivered_live} 条消息已送达"
+                )
+        logger.info(f"摘要已发送 ({chat_id}): {total} 条 / {len(pending)} 人")
+
+digest = DigestBuffer()
+
+# ==================== 发件箱 ====================
+class Outbox:
+    """
+    持久化发件箱: 发送失败的消息写入磁盘, 后台按指数退避 + 抖动重试
+    同一会话按入队顺序逐条发送, 重启后继续; 重试耗尽才报告失败
+    """
+    
+    def __init__(self):
+        self._inflight = set()
+    
+    def has_pending(self, chat_id: int) -> bool:
+        """该会话是否有排队中的消息 (新消息需排在其后以保持顺序)"""
+        return any(job["chat_id"] == chat_id for job in dm.outbox)
+    
+    def enqueue(self, chat_id: int, from_chat_id: int, message_id: int, kind: str = "copy",
+                panel_user: int = None, map_user: int = None, notify: tuple = None,
+                thread_id: int = None):
+        """
+        加入发件箱
+        kind: "copy" 或 "forward"; panel_user: 附带该用户的操作面板;
+        map_user: 成功后记录映射; notify: 结果通知的 (chat_id, message_id);
+        thread_id: 话题模式下发往的话题
+        """
+        dm.outbox.append({
+            "id": uuid.uuid4().hex,
+            "chat_id": chat_id,
+            "from_chat_id": from_chat_id,
+            "message_id": message_id,
+            "kind": kind,
+            "panel_user": panel_user,
+            "map_user": map_user,
+            "notify": list(notify) if notify else None,
+            "thread_id": thread_id,
+            "attempts": 0,
+            "next_at": time.time(),
+        })
+        dm.save_outbox()
+        logger.info(f"发件箱入队: {from_chat_id}/{message_id} -> {chat_id}")
+    
+    async def run(self, bot):
+        """后台循环: 每个会话只取队首任务, 到期即发送"""
+        semaphore = asyncio.Semaphore(OUTBOX_CONCURRENCY)
+        while True:
+            await asyncio.sleep(OUTBOX_POLL_INTERVAL)
+            now = time.time()
+            heads = {}
+            for job in dm.outbox:
+                heads.setdefault(job["chat_id"], job)
+            for job in heads.values():
+                if job["next_at"] <= now and job["id"] not in self._inflight:
+                    self._inflight.add(job["id"])
+                    start_background(self._attempt(bot, job, semaphore))
+    
+    async def _send(self, bot, job):
+        markup = build_panel_keyboard(job["panel_user"]) if job["panel_user"] else None
+        thread_id = job.get("thread_id")
+        if job["kind"] == "forward":
+            return await bot.forward_message(
+                chat_id=job["chat_id"], from_chat_id=job["from_chat_id"],
+                message_id=job["message_id"], message_thread_id=thread_id
+            )
+        return await bot.copy_message(
+            chat_id=job["chat_id"], from_chat_id=job["from_chat_id"],
+            message_id=job["message_id"], reply_markup=markup, message_thread_id=thread_id
+        )
+    
+    async def _attempt(self, bot, job, semaphore):
+        try:
+            async with semaphore:
+                try:
+                    sent = await self._send(bot, job)
+                except RetryAfter as e:
+                    job["next_at"] = time.time() + retry_after_seconds(e)
+                    dm.save_outbox()
+                    return
+                except TelegramError as e:
+                    kind = classify_send_error(e)
+                    job["attempts"] += 1
+                    if kind == "transient" and job["attempts"] < OUTBOX_MAX_ATTEMPTS:
+                        delay = min(OUTBOX_MAX_DELAY, OUTBOX_BASE_DELAY * 2 ** job["attempts"])
+                        job["next_at"] = time.time() + delay * random.uniform(0.5, 1.5)
+                        dm.save_outbox()
+                        logger.warning(f"发件箱第 {job['attempts']} 次重试失败 ({job['chat_id']}): {e}")
+                        return
+                    self._remove(job)
+                    if kind in UNREACHABLE_KINDS:
+                        dm.mark_inactive(job["chat_id"], kind)
+                    logger.error(f"发件箱放弃发送 ({job['chat_id']}, {kind}): {e}")
+                    prefix = "多次重试后仍发送失败" if kind == "transient" else SEND_FAILURE_KINDS[kind]
+                    await self._notify(bot, job, f"❌ {prefix}: <code>{html.escape(str(e))}</code>")
+                    return
+            
+            self._remove(job)
+            if job["map_user"] and job["kind"] == "forward":
+                dm.user_mapping[sent.message_id] = job["map_user"]
+                dm.mark_dirty("mapping")
+            await self._notify(bot, job, "✅ 已送达 (重试成功)")
+        finally:
+            self._inflight.discard(job["id"])
+    
+    def _remove(self, job):
+        dm.outbox = [j for j in dm.outbox if j["id"] != job["id"]]
+        dm.save_outbox()
+    
+    async def _notify(self, bot, job, text: str):
+        if not job["notify"]:
+            return
+        chat_id, message_id = job["notify"]
+        try:
+            await bot.send_message(
+                chat_id=chat_id, text=text, parse_mode=ParseMode.HTML,
+                reply_to_message_id=message_id
+            )
+        except TelegramError as e:
+            logger.debug(f"发件箱通知失败: {e}")
+
+outbox = Outbox()
+
+# ==================== 内容过滤 ====================
+# 动作按严重程度排序, 同时命中多条规则时取最严重的
+FILTER_ACTIONS = ("drop", "quarantine", "ban")
+FILTER_KINDS = ("word", "regex", "domain")
+FILTER_ACTION_LABELS = {"drop": "丢弃", "quarantine": "隔离", "ban": "拉黑"}
+# 正则中的全局内联标志, 这类正则不能与其他正则合并
+FILTER_GLOBAL_FLAGS = re.compile(r"\(\?[aiLmsux]+\)")
+
+class AhoCorasick:
+    """
+    多关键词自动机: 构建 O(模式总长), 一次扫描文本即可找出所有关键词中最严重的命中
+    每个节点预先合并失败链上的最高严重度, 扫描时无需沿失败链收集输出
+    """
+    
+    def __init__(self, patterns):
+        """patterns: [(关键词, 严重度)], 关键词需已 casefold"""
+        self.goto = [{}]
+        self.fail = [0]
+        self.best = [(0, None)]     # 该节点 (含失败链) 上最严重的 (严重度, 关键词)
+        for word, severity in patterns:
+            node = 0
+            for ch in word:
+                nxt = self.goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[node][ch] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.best.append((0, None))
+                node = nxt
+            if severity > self.best[node][0]:
+                self.best[node] = (severity, word)
+        
+        # 按层 BFS 计算失败指针, 父层总是先完成
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self.goto[node].items():
+                queue.append(nxt)
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                if self.best[self.fail[nxt]][0] > self.best[nxt][0]:
+                    self.best[nxt] = self.best[self.fail[nxt]]
+    
+    def __len__(self) -> int:
+        return len(self.goto)
+    
+    def search(self, text: str, stop_at: int) -> tuple:
+        """返回 (最高严重度, 关键词); 达到 stop_at 时提前结束"""
+        goto, fail, best = self.goto, self.fail, self.best
+        node = 0
+        top = (0, None)
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if best[node][0] > top[0]:
+                top = best[node]
+                if top[0] >= stop_at:
+                    break
+        return top
+
+class ContentFilter:
+    """
+    转发前的内容过滤: 关键词 (Aho-Corasick)、正则 (按动作尽量合并)、链接域名 (含子域名)
+    规则文件每行: <drop|quarantine|ban> <word|regex|domain> <内容>, # 开头为注释
+    重新加载时在线程中构建新规则再整体替换, 不阻塞也不暂停消息处理
+    """
+    
+    def __init__(self):
+        self.rules = []             # [(动作, 类型, 内容)]
+        self.invalid = 0
+        self.loaded_at = None
+        self._compiled = None
+    
+    @staticmethod
+    def parse(lines) -> tuple:
+        """解析规则行, 返回 (有效规则, 无效行数)"""
+        rules, invalid = [], 0
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            parts = line.split(None, 2)
+            if len(parts) != 3 or parts[0] not in FILTER_ACTIONS or parts[1] not in FILTER_KINDS:
+                invalid += 1
+                continue
+            if parts[1] == "regex":
+                try:
+                    re.compile(parts[2], re.IGNORECASE)
+                except re.error:
+                    invalid += 1
+                    continue
+            rules.append(tuple(parts))
+        return rules, invalid
+    
+    @staticmethod
+    def merge_regexes(patterns: list) -> list:
+        """
+        把同一动作的正则合并成一个以便一次扫描完成
+        带分组 (合并后反向引用编号会错位) 或全局标志 (如 (?i), 只能出现在开头) 的单独编译
+        """
+        merged, separate = [], []
+        for pattern in patterns:
+            regex = re.compile(pattern, re.IGNORECASE)
+            if regex.groups or FILTER_GLOBAL_FLAGS.search(pattern):
+                separate.append(regex)
+            else:
+                merged.append(pattern)
+        if len(merged) > 1:
+            try:
+                separate.insert(0, re.compile("|".join(f"(?:{p})" for p in merged), re.IGNORECASE))
+            except re.error:
+                separate[:0] = [re.compile(p, re.IGNORECASE) for p in merged]
+        elif merged:
+            separate.insert(0, re.compile(merged[0], re.IGNORECASE))
+        return separate
+    
+    @staticmethod
+    def compile(rules: list) -> dict:
+        severity = {action: i + 1 for i, action in enumerate(FILTER_ACTIONS)}
+        words, regexes, domains = [], {}, {}
+        for action, kind, pattern in rules:
+            level = severity[action]
+            if kind == "word":
+                words.append((pattern.casefold(), level))
+            elif kind == "regex":
+                regexes.setdefault(level, []).append(pattern)
+            else:
+                domain = pattern.lower().lstrip("*.").rstrip(".")
+                domains[domain] = max(level, domains.get(domain, 0))
+        return {
+            "words": AhoCorasick(words),
+            # 严重的动作排在前面, 命中即可停止
+            "regexes": [(level, regex) for level, patterns in sorted(regexes.items(), reverse=True)
+                        for regex in ContentFilter.merge_regexes(patterns)],
+            "domains": domains,
+        }
+    
+    async def build(self, lines) -> tuple:
+        """解析并在线程中编译规则, 返回 (规则, 无效行数, 编译结果); 编译失败抛出 re.error"""
+        rules, invalid = self.parse(lines)
+        compiled = await asyncio.to_thread(self.compile, rules)
+        return rules, invalid, compiled
+    
+    async def reload(self) -> str:
+        """从 FILTER_FILE 重新加载, 返回加载结果说明; 失败时保留原有规则"""
+        try:
+            with open(FILTER_FILE, 'r', encoding='utf-8') as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            lines = []
+        try:
+            built = await self.build(lines)
+        except re.error as e:
+            logger.error(f"内容过滤规则编译失败, 保留原有规则: {e}")
+            return f"编译失败 ({e}), 仍使用原有 {len(self.rules)} 条规则"
+        return self.install(*built)
+    
+    def install(self, rules: list, invalid: int, compiled: dict) -> str:
+        """整体替换为新规则, 返回加载结果说明"""
+        self.rules, self.invalid, self._compiled = rules, invalid, compiled
+        self.loaded_at = datetime.now()
+        summary = f"{len(rules)} 条规则" + (f", 忽略 {invalid} 行无效规则" if invalid else "")
+        logger.info(f"内容过滤规则已加载: {summary}")
+        return summary
+    
+    @staticmethod
+    def message_domains(message) -> set:
+        """消息中链接 (含隐藏在文字里的链接) 的域名"""
+        hosts = set()
+        for entities in (message.parse_entities(), message.parse_caption_entities()):
+            for entity, text in entities.items():
+                if entity.type == MessageEntity.URL:
+                    url = text if "://" in text else f"http://{text}"
+                elif entity.type == MessageEntity.TEXT_LINK:
+                    url = entity.url
+                else:
+                    continue
+                try:
+                    host = urlsplit(url).hostname
+                except ValueError:
+                    continue
+                if host:
+                    hosts.add(host.rstrip("."))
+        return hosts
+    
+    def check(self, text: str, hosts=()) -> tuple:
+        """返回 (动作, 命中内容), 未命中返回 None"""
+        compiled = self._compiled
+        if not compiled:
+            return None
+        top_level = len(FILTER_ACTIONS)
+        level, matched = compiled["words"].search(text.casefold(), top_level) if text else (0, None)
+        
+        domains = compiled["domains"]
+        for host in hosts:
+            labels = host.split(".")
+            for i in range(len(labels)):
+                suffix = ".".join(labels[i:])
+                if domains.get(suffix, 0) > level:
+                    level, matched = domains[suffix], suffix
+        
+        for regex_level, regex in compiled["regexes"]:
+            if regex_level <= level:
+                break
+            match = regex.search(text) if text else None
+            if match:
+                level, matched = regex_level, match.group(0)
+                break
+        
+        return (FILTER_ACTIONS[level - 1], matched) if level else None
+    
+    def check_message(self, message) -> tuple:
+        if not self._compiled:
+            return None
+        text = message.text or message.caption or ""
+        return self.check(text, self.message_domains(message))
+
+content_filter = ContentFilter()
+
+async def apply_filter_action(bot, user, message, action: str, matched: str):
+    """执行过滤动作: 丢弃 / 隔离待主人放行 / 自动拉黑"""
+    dm.statistics["filtered_messages"] = dm.statistics.get("filtered_messages", 0) + 1
+    dm.mark_dirty("stats")
+    logger.info(f"内容过滤 ({action}): {user.id} 命中 {matched!r}")
+    if action == "drop":
+        return
+    
+    if action == "ban":
+        dm.add_to_blacklist(user.id)
+        text = f"🛡️ 已自动拉黑 {user.mention_html()} <code>{user.id}</code>"
+        keyboard = build_panel_keyboard(user.id, banned=True)
+    else:
+        text = f"🛡️ 已隔离 {user.mention_html()} <code>{user.id}</code> 的消息"
+        keyboard = InlineKeyboardMarkup([[
+            InlineKeyboardButton("✅ 放行", callback_data=f"qrel:{message.chat_id}:{message.message_id}")
+        ]])
+    text += (f"\n命中: <code>{html.escape(str(matched)[:50])}</code>"
+             f"\n内容: {html.escape(message_preview(message))}")
+    try:
+        await bot.send_message(chat_id=dm.owner_id, text=text, reply_markup=keyboard, parse_mode=ParseMode.HTML)
+        header_cache.reset(dm.owner_id)
+    except TelegramError as e:
+        logger.error(f"过滤通知发送失败: {e}")
+
+@owner_only
+async def filter_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    内容过滤规则管理:
+    /filter                         查看状态
+    /filter reload                  从规则文件重新加载
+    /filter add <动作> <类型> <内容>  添加规则
+    /filter del <内容>               删除内容相同的规则
+    /filter test <文本>              测试文本会命中什么
+    """
+    args = context.args
+    sub = args[0].lower() if args else ""
+    
+    if sub == "reload":
+        summary = await content_filter.reload()
+        await update.message.reply_html(f"🛡️ 已重新加载: {summary}")
+        return
+    
+    if sub in ("add", "del"):
+        raw = update.message.text.split(None, 2)[2] if len(args) > 1 else ""
+        try:
+            with open(FILTER_FILE, 'r', encoding='utf-8') as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            lines = []
+        if sub == "add":
+            rules, _ = ContentFilter.parse([raw])
+            if not rules:
+                await update.message.reply_html(
+                    "用法: /filter add &lt;drop|quarantine|ban&gt; &lt;word|regex|domain&gt; &lt;内容&gt;"
+                )
+                return
+            lines.append(" ".join(rules[0]) + "\n")
+        else:
+            kept = [line for line in lines
+                    if line.strip().startswith("#") or line.strip().split(None, 2)[2:] != [raw.strip()]]
+            if len(kept) == len(lines):
+                await update.message.reply_html("⚠️ 没有找到该规则")
+                return
+            lines = kept
+        # 先编译新规则集, 失败则不写文件, 以免坏规则让之后每次启动都加载失败
+        try:
+            built = await content_filter.build(lines)
+        except re.error as e:
+            await update.message.reply_html(f"⚠️ 规则无法编译, 未保存: <code>{html.escape(str(e))}</code>")
+            return
+        tmp_path = FILTER_FILE + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.writelines(lines)
+        os.replace(tmp_path, FILTER_FILE)
+        summary = content_filter.install(*built)
+        await update.message.reply_html(f"🛡️ 规则已{'添加' if sub == 'add' else '删除'}, 当前 {summary}")
+        return
+    
+    if sub == "test":
+        text = update.message.text.split(None, 2)[2] if len(args) > 1 else ""
+        started = time.perf_counter()
+        verdict = content_filter.check(text, ContentFilter.message_domains(update.message))
+        elapsed = (time.perf_counter() - started) * 1e6
+        result = (f"{FILTER_ACTION_LABELS[verdict[0]]} (命中 <code>{html.escape(str(verdict[1]))}</code>)"
+                  if verdict else "未命中")
+        await update.message.reply_html(f"🛡️ 测试结果: {result}\n耗时 {elapsed:.0f}µs")
+        return
+    
+    counts = Counter((action, kind) for action, kind, _ in content_filter.rules)
+    lines = [f"🛡️ <b>内容过滤</b>\n\n规则文件: <code>{FILTER_FILE}</code>"]
+    if content_filter.loaded_at:
+        lines.append(f"加载时间: {content_filter.loaded_at:%m-%d %H:%M:%S}")
+    for kind in FILTER_KINDS:
+        per_action = " · ".join(f"{FILTER_ACTION_LABELS[a]} {counts[(a, kind)]}" for a in FILTER_ACTIONS)
+        lines.append(f"• {kind}: {per_action}")
+    if content_filter.invalid:
+        lines.append(f"⚠️ 无效规则 {content_filter.invalid} 行")
+    lines.append(f"已过滤 {dm.statistics.get('filtered_messages', 0)} 条消息")
+    await update.message.reply_html("\n".join(lines))
+
+# ==================== 重复内容抑制 ====================
+def content_fingerprint(message) -> tuple:
+    """
+    内容指纹: 文本取规范化后的哈希, 媒体取 file_unique_id (+ 说明文字哈希)
+    返回 (指纹, 是否参与跨用户刷屏判定); 无法识别的消息返回 (None, False)
+    """
+    digest = lambda text: hashlib.blake2b(text.encode(), digest_size=8).hexdigest()
+    kind = message_kind(message)
+    if kind == "text":
+        normalized = " ".join(message.text.casefold().split())
+        return f"t:{digest(normalized)}", len(normalized) >= FLOOD_MIN_TEXT_LEN
+    media = getattr(message, kind, None)
+    if kind == "photo":
+        media = media[-1]
+    file_unique_id = getattr(media, "file_unique_id", None)
+    if not file_unique_id:
+        return None, False
+    caption = " ".join((message.caption or "").casefold().split())
+    fingerprint = f"{kind}:{file_unique_id}" + (f":{digest(caption)}" if caption else "")
+    # 热门贴纸会被很多人正常使用, 不参与刷屏判定
+    return fingerprint, kind != "sticker"
+
+class RepeatSuppressor:
+    """
+    按内容指纹抑制重复: 同一用户窗口内的重复只转发第一条, 其余汇总为一条 "×N" 提示;
+    不同用户发送相同内容达到阈值视为刷屏
+    两张表按首次出现的顺序排列, 过期或超出容量时从最旧的一端淘汰
+    """
+    
+    def __init__(self, window: float, max_entries: int):
+        self.window = window
+        self.max_entries = max_entries
+        self.per_user = OrderedDict()   # {(user_id, 指纹): [首次时间, 次数, 提示消息]}
+        self.senders = OrderedDict()    # {指纹: [首次时间, {user_id}, 提示消息]}
+    
+    def _expire(self, table: OrderedDict, now: float):
+        while table:
+            entry = next(iter(table.values()))
+            if now - entry[0] <= self.window and len(table) <= self.max_entries:
+                break
+            table.popitem(last=False)
+    
+    def observe(self, user_id: int, fingerprint: str, flood_check: bool) -> tuple:
+        """
+        记录一次出现, 返回 (判定, 记录)
+        判定: "new" 首次出现, "repeat" 同一用户重复, "flood" 多个用户发送相同内容
+        """
+        now = time.monotonic()
+        self._expire(self.per_user, now)
+        self._expire(self.senders, now)
+        
+        entry = self.per_user.get((user_id, fingerprint))
+        if entry:
+            entry[1] += 1
+            return "repeat", entry
+        self.per_user[(user_id, fingerprint)] = [now, 1, None]
+        
+        if not flood_check:
+            return "new", None
+        shared = self.senders.get(fingerprint)
+        if shared is None:
+            shared = self.senders[fingerprint] = [now, set(), None]
+        if len(shared[1]) < FLOOD_USER_THRESHOLD * 10:
+            shared[1].add(user_id)
+        return ("flood", shared) if len(shared[1]) >= FLOOD_USER_THRESHOLD else ("new", None)
+
+repeats = RepeatSuppressor(REPEAT_WINDOW, REPEAT_MAX_ENTRIES)
+
+async def report_repeat(bot, user, message, verdict: str, entry: list):
+    """
+    维护一条重复内容的汇总提示: 首次重复时发送, 之后只在次数翻倍时更新, API 调用随重复次数对数增长
+    同一用户的重复和开启自动拉黑时的刷屏不再转发; 未开启自动拉黑时刷屏消息照常转发, 提示只作提醒
+    """
+    suppressed = verdict == "repeat" or FLOOD_AUTO_BLOCK
+    if suppressed:
+        dm.statistics["suppressed_repeats"] = dm.statistics.get("suppressed_repeats", 0) + 1
+        dm.mark_dirty("stats")
+    preview = html.escape(message_preview(message))
+    if verdict == "repeat":
+        count = entry[1]
+        text = f"🔁 {user.mention_html()} <code>{user.id}</code> 重复发送相同内容 ×{count}\n{preview}"
+        keyboard = build_panel_keyboard(user.id)
+    else:
+        if FLOOD_AUTO_BLOCK:
+            # 首次判定为刷屏时 (尚无提示消息), 之前发送过相同内容的用户一并拉黑
+            dm.bulk_add("black", entry[1] | {user.id} if entry[2] is None else {user.id})
+            dm.save_blacklist()
+            dm.save_whitelist()
+            dm.save_pending()
+        count = len(entry[1])
+        text = (f"🌊 {count} 个用户在 {REPEAT_WINDOW // 60} 分钟内发送了相同内容"
+                + (" (已自动拉黑)" if FLOOD_AUTO_BLOCK else " (均已照常转发)")
+                + f"\n最近: <code>{user.id}</code>\n{preview}")
+        keyboard = None if FLOOD_AUTO_BLOCK else build_panel_keyboard(user.id)
+    logger.info(f"{'抑制' if suppressed else '检测到'}重复内容 ({verdict}): {user.id} ×{count}")
+    
+    if count & (count - 1) and entry[2]:
+        return  # 不是 2 的幂, 暂不更新提示
+    try:
+        if entry[2]:
+            chat_id, message_id = entry[2]
+            await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id,
+                                        reply_markup=keyboard, parse_mode=ParseMode.HTML)
+        else:
+            chat_id = dm.operator_for(user.id) if verdict == "repeat" else dm.owner_id
+            note = await bot.send_message(chat_id=chat_id, text=text, reply_markup=keyboard,
+                                          parse_mode=ParseMode.HTML)
+            entry[2] = (chat_id, note.message_id)
+            header_cache.reset(chat_id)
+    except TelegramError as e:
+        logger.warning(f"重复提示发送失败: {e}")
+
+# ==================== 消息处理器 ====================
+async def reply_notice(message, text: str):
+    """回执/提示类回复: 失败 (如触发每会话限流) 只记录, 不影响消息本身的投递结果"""
+    try:
+        await message.reply_html(text)
+    except TelegramError as e:
+        logger.debug(f"提示发送失败 ({message.chat_id}): {e}")
+
+async def ack_delivered(message, user_id: int):
+    """送达回执; 积压补处理期间只计数, 结束后每人汇总回执一次"""
+    if catchup.active:
+        catchup.acks[user_id] += 1
+    else:
+        await reply_notice(message, "✅ 已送达")
+
+async def report_inbound_failure(message, error: TelegramError, job: dict = None):
+    """
+    用户消息投递失败 (只针对转发/复制本身): 可重试的错误转入发件箱, 其余直接告知用户
+    job: outbox.enqueue 的目标参数 (chat_id/kind/...), 为 None 时无法排队
+    """
+    logger.error(f"转发失败: {error}")
+    kind = classify_send_error(error)
+    if kind == "transient" and job:
+        outbox.enqueue(from_chat_id=message.chat_id, message_id=message.message_id,
+                       notify=(message.chat_id, message.message_id), **job)
+        await reply_notice(message, "⏳ 暂时无法送达，将自动重试")
+    elif kind == "rejected":
+        await reply_notice(message, "❌ 该消息无法送达，请换一种方式发送")
+    else:
+        await reply_notice(message, "❌ 发送失败，请稍后重试")
+
+def build_panel_keyboard(user_id: int, banned: bool = False) -> InlineKeyboardMarkup:
+    """构建操作面板键盘 (按钮中携带用户ID, 也用于无状态回复路由)"""
+    return InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("✅ 解封" if banned else "🚫 拉黑", callback_data=f"ban:{user_id}"),
+            InlineKeyboardButton("📋 用户信息", callback_data=f"info:{user_id}"),
+            InlineKeyboardButton("🕘 最近往来", callback_data=f"hist:{user_id}")
+        ]
+    ])
+
+# 机器人生成的信息头 (📩 新消息 / 🧵 新会话) 与操作面板 (⚙️) 的开头
+TRUSTED_HEADER_PREFIXES = ("📩", "🧵", "⚙️")
+
+def resolve_target_user(replied, bot_id: int, use_mapping: bool = True):
+    """
+    解析被回复消息对应的用户ID
+    依次尝试: 映射表 -> 面板按钮 -> 信息头/面板中的ID
+    不使用转发来源: 用户转发来的别人的消息, 来源是原作者而不是发给机器人的人
+    """
+    target_user = dm.user_mapping.get(replied.message_id) if use_mapping else None
+    if target_user:
+        return target_user
+    
+    # 以下信息只有机器人自己发出的消息才可信
+    if not replied.from_user or replied.from_user.id != bot_id:
+        return None
+    
+    if replied.reply_markup:
+        for row in replied.reply_markup.inline_keyboard:
+            for button in row:
+                data = button.callback_data or ""
+                if data.startswith("ban:"):
+                    return int(data[4:])
+    
+    # 只信任机器人自己生成的信息头/面板; 转发或复制的用户内容可能伪造代码格式的ID
+    if replied.forward_origin is None and (replied.text or "").startswith(TRUSTED_HEADER_PREFIXES):
+        for value in replied.parse_entities([MessageEntity.CODE]).values():
+            if value.isdigit():
+                return int(value)
+    return None
+
+def build_user_header(user, title: str = "📩 <b>新消息</b>",
+                      hint: str = "👇 回复下方消息以回复该用户") -> str:
+    """构建用户信息头"""
+    username = f"@{user.username}" if user.username else "无"
+    return (
+        f"{title}\n\n"
+        f"👤 {user.mention_html()}\n"
+        f"🆔 <code>{user.id}</code>\n"
+        f"🔗 {username}\n\n"
+        f"{hint}"
+    )
+
+class HeaderCache:
+    """
+    每个接收会话 (主人/客服) 最近一次显示的信息头: 发送者、资料签名与显示时间
+    同一用户连续发消息且资料未变、未超时时, 省略信息头和操作面板
+    """
+    
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.last = {}      # {chat_id: (user_id, 资料签名, 显示时间)}
+    
+    def needs_header(self, chat_id: int, user, header: str) -> bool:
+        """判断是否需要信息头; 需要时即记为已显示"""
+        if not HEADER_SUPPRESSION:
+            return True
+        profile = hashlib.blake2b(header.encode(), digest_size=8).digest()
+        now = time.monotonic()
+        last = self.last.get(chat_id)
+        if last and last[0] == user.id and last[1] == profile and now - last[2] < self.timeout:
+            return False
+        self.last[chat_id] = (user.id, profile, now)
+        return True
+    
+    def reset(self, chat_id: int):
+        """会话中插入了其他内容 (摘要、发送失败等), 下一条消息重新显示信息头"""
+        self.last.pop(chat_id, None)
+
+header_cache = HeaderCache(HEADER_REPEAT_TIMEOUT)
+
+async def get_user_topic(bot, user) -> int:
+    """取得用户的话题ID, 首次使用时创建话题并发送用户资料与操作面板"""
+    thread_id = dm.user_topics.get(user.id)
+    if thread_id:
+        return thread_id
+    
+    topic = await bot.create_forum_topic(
+        chat_id=dm.forum_chat_id, name=f"{user.full_name} ({user.id})"[:128]
+    )
+    thread_id = topic.message_thread_id
+    dm.set_user_topic(user.id, thread_id)
+    try:
+        await bot.send_message(
+            chat_id=dm.forum_chat_id,
+            message_thread_id=thread_id,
+            text=build_user_header(user, title="🧵 <b>新会话</b>",
+                                   hint="💬 在本话题中发送的消息会直接发给该用户"),
+            reply_markup=build_panel_keyboard(user.id),
+            parse_mode=ParseMode.HTML
+        )
+    except TelegramError as e:
+        # 资料卡片只是附加信息, 话题已建好, 不影响消息本身的转发
+        logger.warning(f"话题资料卡片发送失败 ({user.id}): {e}")
+    logger.info(f"为用户 {user.id} 创建话题 {thread_id}")
+    return thread_id
+
+async def forward_to_topic(bot, user, message):
+    """转发到用户的话题, 话题被删除时自动重建"""
+    thread_id = await get_user_topic(bot, user)
+    try:
+        await message.forward(chat_id=dm.forum_chat_id, message_thread_id=thread_id)
+    except BadRequest as e:
+        if "thread not found" not in str(e).lower():
+            raise
+        dm.set_user_topic(user.id, 0)
+        thread_id = await get_user_topic(bot, user)
+        await message.forward(chat_id=dm.forum_chat_id, message_thread_id=thread_id)
+
+@require_auth
+async def forward_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """转发用户消息给主人"""
+    user = update.effective_user
+    message = update.message
+    
+    if dm.is_operator(user.id):
+        if message.media_group_id and user.id == dm.owner_id:
+            remember_owner_album(message)
+        elif not message.reply_to_message:
+            await message.reply_html("💡 请回复转发的消息来回复用户")
+        return
+    
+    verdict = content_filter.check_message(message)
+    if verdict:
+        await apply_filter_action(context.bot, user, message, *verdict)
+        return
+    
+    fingerprint, flood_check = content_fingerprint(message)
+    if fingerprint:
+        verdict, entry = repeats.observe(user.id, fingerprint, flood_check)
+        if verdict != "new":
+            await report_repeat(context.bot, user, message, verdict, entry)
+            if verdict == "repeat":
+                # 普通用户重复发送短句 (如"好的") 时仍应看到送达回执, 内容已汇总给客服
+                await ack_delivered(message, user.id)
+                return
+            if FLOOD_AUTO_BLOCK:
+                return
+            # 未开启自动拉黑时无法确定是刷屏还是巧合 (如群发通知后的相同咨询), 照常转发
+    
+    dm.record_history(user.id, "in", message)
+    
+    if dm.forum_chat_id:
+        # 话题模式: 每个用户一个话题, 回复无需映射
+        try:
+            await forward_to_topic(context.bot, user, message)
+        except TelegramError as e:
+            # 话题尚未建成时无处排队, 只能请用户稍后重试
+            thread_id = dm.user_topics.get(user.id)
+            job = {"chat_id": dm.forum_chat_id, "kind": "forward", "thread_id": thread_id} if thread_id else None
+            await report_inbound_failure(message, e, job)
+            return
+        dm.statistics["total_messages"] += 1
+        dm.mark_dirty("stats")
+        await ack_delivered(message, user.id)
+        return
+    
+    digest.note_inbound()
+    if digest.active or catchup.active:
+        # 摘要模式 (或积压补处理): 暂存, 由 DigestBuffer 汇总发送, 转发成功后再回执
+        digest.add(context.bot, user, message)
+        dm.statistics["total_messages"] += 1
+        dm.mark_dirty("stats")
+        return
+    
+    info_text = build_user_header(user)
+    operator_id = dm.operator_for(user.id)
+    use_copy = ROUTING_MODE == "stateless" or operator_id != dm.owner_id
+    
+    if outbox.has_pending(operator_id):
+        # 前面还有待重试的消息, 排队以保持顺序
+        header_cache.reset(operator_id)
+        outbox.enqueue(
+            operator_id, message.chat_id, message.message_id,
+            kind="copy" if use_copy else "forward",
+            panel_user=user.id if use_copy else None, map_user=user.id,
+            notify=(message.chat_id, message.message_id)
+        )
+        await reply_notice(message, "⏳ 已排队，稍后送达")
+        return
+    
+    # 信息头、面板和回执各自容错, 只有转发/复制本身失败才转入发件箱, 已送达的消息不会重发
+    with_header = header_cache.needs_header(operator_id, user, info_text)
+    if with_header:
+        try:
+            await context.bot.send_message(
+                chat_id=operator_id, 
+                text=info_text, 
+                parse_mode=ParseMode.HTML
+            )
+        except TelegramError as e:
+            logger.warning(f"信息头发送失败 ({operator_id}): {e}")
+            header_cache.reset(operator_id)
+    
+    keyboard = build_panel_keyboard(user.id)
+    try:
+        if use_copy:
+            # 面板直接附在副本上, 回复时从按钮中解析用户ID
+            # (映射表以主人会话的消息ID为键, 其他客服总是使用无状态路由)
+            await message.copy(chat_id=operator_id, reply_markup=keyboard)
+        else:
+            forwarded = await message.forward(chat_id=dm.owner_id)
+    except TelegramError as e:
+        header_cache.reset(operator_id)
+        await report_inbound_failure(message, e, {
+            "chat_id": operator_id, "kind": "copy" if use_copy else "forward",
+            "panel_user": user.id if use_copy else None, "map_user": user.id
+        })
+        return
+    
+    if not use_copy:
+        dm.user_mapping[forwarded.message_id] = user.id
+        dm.mark_dirty("mapping")
+        # 发送控制面板 (连续消息沿用上方已有的面板)
+        if with_header:
+            try:
+                await context.bot.send_message(
+                    chat_id=dm.owner_id,
+                    text=f"⚙️ 操作面板 | 用户: <code>{user.id}</code>",
+                    reply_markup=keyboard,
+                    parse_mode=ParseMode.HTML
+                )
+            except TelegramError as e:
+                logger.warning(f"操作面板发送失败: {e}")
+                header_cache.reset(operator_id)
+    
+    dm.statistics["total_messages"] += 1
+    dm.mark_dirty("stats")
+    if dm.operators:
+        dm.count_operator(operator_id, "forwarded")
+    
+    await ack_delivered(message, user.id)
+    logger.info(f"转发消息: {user.id} -> {operator_id}")
+
+async def deliver_reply(message, target_user: int, ack: bool = True):
+    """把主人/客服的消息复制给用户, 并处理不可达"""
+    if not dm.is_reachable(target_user):
+        reason = SEND_FAILURE_KINDS[dm.inactive[target_user]["reason"]]
+        await reply_notice(message, f"💤 该用户不可达 ({reason})，已跳过\n对方再次发消息后会自动恢复")
+        return
+    
+    if outbox.has_pending(target_user):
+        outbox.enqueue(target_user, message.chat_id, message.message_id,
+                       notify=(message.chat_id, message.message_id))
+        await reply_notice(message, "⏳ 前面还有待重试的消息，已排队")
+        return
+    
+    # 只有复制本身失败才重试; 回执失败不能导致回复被重发
+    try:
+        await message.copy(chat_id=target_user)
+    except TelegramError as e:
+        kind = classify_send_error(e)
+        if kind == "transient":
+            outbox.enqueue(target_user, message.chat_id, message.message_id,
+                           notify=(message.chat_id, message.message_id))
+            await reply_notice(message, "⏳ 发送暂时失败，已加入重试队列")
+            return
+        if kind == "rejected":
+            await reply_notice(message, f"❌ 发送失败: <code>{html.escape(str(e))}</code>")
+            return
+        dm.mark_inactive(target_user, kind)
+        await reply_notice(message, (
+            f"❌ 发送失败: <code>{html.escape(str(e))}</code>\n\n"
+            f"该用户{SEND_FAILURE_KINDS[kind]}，已标记为不可达"
+        ))
+        return
+    
+    dm.record_history(target_user, "out", message)
+    dm.statistics["total_replies"] += 1
+    dm.mark_dirty("stats")
+    if dm.operators:
+        dm.count_operator(message.from_user.id, "replies")
+    if ack and not catchup.active:
+        await reply_notice(message, "✅ 已发送")
+    logger.info(f"回复消息: {message.from_user.id} -> {target_user}")
+
+@operator_only
+async def reply_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """主人/客服回复消息"""
+    message = update.message
+    # 映射表只记录主人会话中的消息
+    replied = message.reply_to_message
+    target_user = resolve_target_user(
+        replied, context.bot.id, use_mapping=message.chat_id == dm.owner_id
+    )
+    
+    if not target_user:
+        await message.reply_html("⚠️ 找不到原始用户记录")
         return
     
-    action, user_id_str = query.data.split(":")
-    user_id = int(user_id_str)
+    # 客服只能回复分配给自己的会话, 主人不受限制
+    assigned = dm.assignments.get(target_user)
+    if context.access.role == "operator" and assigned not in (None, message.from_user.id):
+        await message.reply_html("⚠️ 该会话已分配给其他客服")
+        return
+    
+    await deliver_reply(message, target_user)
+
+@owner_only
+async def topic_reply_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """话题模式: 主人在用户话题中发送的任何消息直接发给该用户"""
+    message = update.message
+    target_user = dm.topic_users.get(message.message_thread_id) if message.is_topic_message else None
+    if target_user:
+        await deliver_reply(message, target_user, ack=False)
+
+@owner_only
+async def assign_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """手动分配会话: /assign [用户ID] [客服ID]"""
+    try:
+        user_id, operator_id = int(context.args[0]), int(context.args[1])
+    except (IndexError, ValueError):
+        await update.message.reply_html("用法: /assign [用户ID] [客服ID]")
+        return
+    if not dm.is_operator(operator_id):
+        await update.message.reply_html("该ID不是客服")
+        return
+    dm.assign(user_id, operator_id)
+    await update.message.reply_html(f"✅ 用户 <code>{user_id}</code> 已分配给 <code>{operator_id}</code>")
+
+# ==================== 回调处理器 ====================
+async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """处理按钮回调"""
+    query = update.callback_query
+    await query.answer()
+    
+    if context.access.role not in ("owner", "operator"):
+        return
+    
+    action, _, payload = query.data.partition(":")
+    
+    if action in ("lspage", "lsdel"):
+        if context.access.role != "owner":
+            return
+        await list_callback(query, action, payload)
+        return
+    
+    if action == "qrel":
+        # 放行被隔离的消息: 按无状态方式附带面板复制给主人
+        if context.access.role != "owner":
+            return
+        chat_id, message_id = (int(x) for x in payload.split(":"))
+        try:
+            await context.bot.copy_message(
+                chat_id=dm.owner_id, from_chat_id=chat_id, message_id=message_id,
+                reply_markup=build_panel_keyboard(chat_id)
+            )
+            header_cache.reset(dm.owner_id)
+            await query.edit_message_text(query.message.text_html + "\n\n✅ 已放行", parse_mode=ParseMode.HTML)
+        except TelegramError as e:
+            await query.answer(f"放行失败: {e}", show_alert=True)
+        return
+    
+    user_id = int(payload)
     
     if action == "ban":
         if user_id in dm.blacklist:
             dm.remove_from_blacklist(user_id)
             status = "✅ 已解封"
-            btn_text = "🚫 拉黑"
         else:
             dm.add_to_blacklist(user_id)
             status = "🚫 已拉黑"
-            btn_text = "✅ 解封"
         
-        keyboard = InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton(btn_text, callback_data=f"ban:{user_id}"),
-                InlineKeyboardButton("📋 用户信息", callback_data=f"info:{user_id}")
-            ]
-        ])
+        keyboard = build_panel_keyboard(user_id, banned=user_id in dm.blacklist)
+        
+        if not (query.message.text or "").startswith("⚙️"):
+            # 无状态模式下面板附在用户消息副本上, 只更新按钮
+            await query.edit_message_reply_markup(reply_markup=keyboard)
+            return
         
         await query.edit_message_text(
             f"⚙️ 操作面板 | 用户: <code>{user_id}</code>\n状态: {status}",
@@ -526,17 +2581,763 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif action == "info":
         in_whitelist = "✅ 是" if user_id in dm.whitelist else "❌ 否"
         in_blacklist = "✅ 是" if user_id in dm.blacklist else "❌ 否"
-        msg_count = sum(1 for uid in dm.user_mapping.values() if uid == user_id)
+        reachable = ("✅ 是" if dm.is_reachable(user_id)
+                     else f"❌ {SEND_FAILURE_KINDS[dm.inactive[user_id]['reason']]}")
+        msg_count = dm.history.counts.get(user_id, 0)
         
         await query.answer(
-            f"白名单: {in_whitelist}\n黑名单: {in_blacklist}\n消息数: {msg_count}",
+            f"白名单: {in_whitelist}\n黑名单: {in_blacklist}\n可达: {reachable}\n消息数: {msg_count}",
             show_alert=True
         )
+    
+    elif action == "hist":
+        await query.message.reply_html(format_history(user_id))
+
+def format_history(user_id: int) -> str:
+    """渲染用户最近的往来记录 (← 用户发来, → 回复)"""
+    entries = dm.history.recent(user_id)
+    if not entries:
+        return f"🕘 用户 <code>{user_id}</code> 暂无往来记录"
+    lines = [f"🕘 <b>最近往来</b> | 用户 <code>{user_id}</code> (共收到 {dm.history.counts.get(user_id, 0)} 条)\n"]
+    for ts, direction, _, preview in entries:
+        arrow = "←" if direction == "in" else "→"
+        lines.append(f"{arrow} {datetime.fromtimestamp(ts):%m-%d %H:%M} {html.escape(preview)}")
+    return "\n".join(lines)
+
+async def list_callback(query, action: str, payload: str):
+    """黑/白名单分页与逐条移除"""
+    if action == "lspage":
+        kind, start = payload.split(":")
+    else:
+        kind, uid, start = payload.split(":")
+        if kind == "b":
+            dm.remove_from_blacklist(int(uid))
+        else:
+            dm.remove_from_whitelist(int(uid))
+    
+    text, keyboard = build_list_page(kind, int(start))
+    if keyboard is None and action == "lsdel":
+        # 当前页已删空, 回到上一页
+        text, keyboard = build_list_page(kind)
+    await query.edit_message_text(text, reply_markup=keyboard, parse_mode=ParseMode.HTML)
+
+# ==================== 诊断工具 ====================
+class StackSampler(threading.Thread):
+    """后台线程定时采样主线程调用栈, 生成 collapsed-stack 火焰图数据"""
+    
+    def __init__(self, thread_id: int, interval: float = PROFILE_SAMPLE_INTERVAL):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop_event = threading.Event()
+    
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+    
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+    
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+_profile_running = False
+
+class LoopMonitor:
+    """事件循环延迟监控: 采样调度延迟, 并由看门狗线程捕获阻塞事件循环的调用栈"""
+    
+    def __init__(self):
+        self.samples = deque(maxlen=LAG_WINDOW)
+        self._due = float("inf")        # 采样任务本应醒来的时刻 (不在休眠时为无穷大)
+        self._loop_thread_id = None
+        self._reported_due = None
+        self._over_count = 0
+        self._last_alert = 0.0
+    
+    def start(self, application: Application):
+        """在事件循环中启动采样任务和看门狗线程"""
+        self._loop_thread_id = threading.get_ident()
+        start_background(self._sample_loop(application.bot))
+        threading.Thread(target=self._watchdog, daemon=True).start()
+    
+    async def _sample_loop(self, bot):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            self._due = time.monotonic() + LAG_SAMPLE_INTERVAL
+            await asyncio.sleep(LAG_SAMPLE_INTERVAL)
+            lag = max(0.0, loop.time() - started - LAG_SAMPLE_INTERVAL)
+            self._due = float("inf")  # 发送告警期间在等待网络, 不算阻塞
+            self.samples.append(lag)
+            await self._check_alert(bot, lag)
+    
+    async def _check_alert(self, bot, lag: float):
+        self._over_count = self._over_count + 1 if lag > LAG_ALERT_THRESHOLD else 0
+        now = time.monotonic()
+        if self._over_count < LAG_ALERT_SUSTAIN or now - self._last_alert < LAG_ALERT_COOLDOWN:
+            return
+        self._last_alert = now
+        try:
+            await bot.send_message(
+                chat_id=dm.owner_id,
+                text=(
+                    "🐢 <b>事件循环延迟告警</b>\n\n"
+                    f"连续 {self._over_count} 次采样延迟超过 {LAG_ALERT_THRESHOLD:.1f}s\n"
+                    f"当前: <b>{lag * 1000:.0f}ms</b>"
+                ),
+                parse_mode=ParseMode.HTML
+            )
+        except TelegramError as e:
+            logger.error(f"延迟告警发送失败: {e}")
+    
+    def _watchdog(self):
+        """采样任务到点后迟迟未醒说明事件循环被阻塞, 记录此刻事件循环线程的调用栈"""
+        while True:
+            time.sleep(SLOW_CALLBACK_THRESHOLD / 2)
+            due = self._due
+            blocked = time.monotonic() - due
+            if blocked <= SLOW_CALLBACK_THRESHOLD or due == self._reported_due:
+                continue
+            self._reported_due = due
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else "(无)"
+            logger.warning(f"事件循环已阻塞 {blocked:.2f}s, 当前调用栈:\n{stack}")
+    
+    def percentiles(self) -> dict:
+        """返回最近窗口内的延迟分位数 (毫秒)"""
+        if not self.samples:
+            return {}
+        ordered = sorted(self.samples)
+        pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+        return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": ordered[-1] * 1000}
+
+loop_monitor = LoopMonitor()
+
+@owner_only
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """采集一段时间的 CPU 性能数据: /profile [秒数] [flame]"""
+    global _profile_running
+    
+    try:
+        seconds = int(context.args[0]) if context.args else 30
+    except ValueError:
+        await update.message.reply_html("用法: /profile [秒数] [flame]")
+        return
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    with_flame = "flame" in context.args[1:]
+    
+    if _profile_running:
+        await update.message.reply_html("⚠️ 已有性能采集在进行中")
+        return
+    
+    _profile_running = True
+    await update.message.reply_html(f"⏱️ 开始采集 <b>{seconds}</b> 秒性能数据...")
+    
+    profiler = cProfile.Profile()
+    sampler = StackSampler(threading.get_ident()) if with_flame else None
+    try:
+        if sampler:
+            sampler.start()
+        profiler.enable()
+        # 处理器以 block=False 注册, 采集期间事件循环照常处理真实流量
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+        if sampler:
+            sampler.stop()
+        _profile_running = False
+    
+    report = io.StringIO()
+    stats = pstats.Stats(profiler, stream=report)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(50)
+    stamp = f"{datetime.now():%Y%m%d_%H%M%S}"
+    
+    await update.message.reply_document(
+        document=report.getvalue().encode("utf-8"),
+        filename=f"profile_{stamp}.txt",
+        caption=f"📈 {seconds} 秒性能报告 (按累计耗时排序)"
+    )
+    if sampler:
+        await update.message.reply_document(
+            document=sampler.collapsed().encode("utf-8"),
+            filename=f"profile_{stamp}.collapsed",
+            caption=f"🔥 火焰图数据 ({sum(sampler.stacks.values())} 个样本)"
+        )
+    logger.info(f"性能采集完成: {seconds} 秒")
+
+def read_rss() -> int:
+    """当前进程常驻内存 (字节); 非 Linux 平台退化为峰值 RSS"""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def deep_sizeof(obj) -> int:
+    """递归估算对象及其引用的容器/实例属性的总大小 (字节), 共享对象只计一次"""
+    seen = set()
+    stack = [obj]
+    total = 0
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        total += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset, deque)):
+            stack.extend(item)
+        elif hasattr(item, "__dict__"):
+            stack.append(vars(item))
+    return total
+
+def format_bytes(size: float) -> str:
+    for unit in ("B", "KB", "MB"):
+        if abs(size) < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+class MemoryTracker:
+    """对象计数与分配追踪的基线, 每次 /memstats 与上一次对比"""
+    
+    def __init__(self):
+        self.counts = None          # 上一次的 {类型名: 对象数}
+        self.counted_at = None
+        self.snapshot = None        # tracemalloc 基线快照
+    
+    def count_growth(self) -> list:
+        """统计各类型对象数, 返回自上次以来增长最多的 [(类型名, 当前数, 增量)]"""
+        counts = Counter(type(o).__name__ for o in gc.get_objects())
+        previous = self.counts or {}
+        growth = [(name, n, n - previous.get(name, 0)) for name, n in counts.items()]
+        growth.sort(key=lambda item: item[2], reverse=True)
+        self.counts = counts
+        self.counted_at = datetime.now()
+        return [item for item in growth[:MEMSTATS_TOP] if item[2] > 0]
+    
+    def start_trace(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(MEMSTATS_TRACE_FRAMES)
+        self.snapshot = tracemalloc.take_snapshot()
+    
+    def stop_trace(self):
+        tracemalloc.stop()
+        self.snapshot = None
+    
+    def trace_diff(self) -> list:
+        """与基线快照对比, 返回净增长最多的分配位置"""
+        if not tracemalloc.is_tracing() or self.snapshot is None:
+            return []
+        current = tracemalloc.take_snapshot().filter_traces(
+            (tracemalloc.Filter(False, tracemalloc.__file__),)
+        )
+        return current.compare_to(self.snapshot, "lineno")[:MEMSTATS_TOP]
+
+memory_tracker = MemoryTracker()
+
+@owner_only
+async def memstats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """内存占用报告: /memstats [trace on|off]"""
+    args = [a.lower() for a in context.args]
+    if args[:1] == ["trace"]:
+        if args[1:2] == ["off"]:
+            memory_tracker.stop_trace()
+            await update.message.reply_html("🧠 已关闭内存分配追踪")
+        else:
+            memory_tracker.start_trace()
+            await update.message.reply_html("🧠 已开启内存分配追踪并记录基线，稍后再次执行 /memstats 查看增长")
+        return
+    
+    lines = [f"🧠 <b>内存报告</b>\n\n进程 RSS: <b>{format_bytes(read_rss())}</b>\n"]
+    
+    lines.append("<b>数据结构 (估算):</b>")
+    for field in MEMSTATS_FIELDS:
+        value = getattr(dm, field)
+        lines.append(f"• {field}: {len(value)} 项, {format_bytes(deep_sizeof(value))}")
+    
+    since = memory_tracker.counted_at
+    growth = memory_tracker.count_growth()
+    if since is None:
+        lines.append("\n已记录对象计数基线，再次执行查看增长")
+    else:
+        lines.append(f"\n<b>对象增长 (自 {since:%m-%d %H:%M:%S}):</b>")
+        lines.extend(f"• {html.escape(name)}: {count} (+{delta})" for name, count, delta in growth)
+        if not growth:
+            lines.append("• 无增长")
+    
+    if tracemalloc.is_tracing():
+        lines.append("\n<b>分配增长 (对比基线):</b>")
+        for stat in memory_tracker.trace_diff():
+            frame = stat.traceback[0]
+            location = f"{os.path.basename(frame.filename)}:{frame.lineno}"
+            lines.append(f"• <code>{html.escape(location)}</code> {format_bytes(stat.size_diff)} ({stat.count_diff:+d})")
+    else:
+        lines.append("\n分配追踪未开启 (/memstats trace on)")
+    
+    await update.message.reply_html("\n".join(lines))
+
+# ==================== 流量录制 ====================
+class TrafficRecorder:
+    """
+    将收到的 Update 匿名化后写入 gzip 压缩的 NDJSON, 供 replay_traffic.py 回放
+    首行为元信息, 之后每行 {"t": 接收时间戳, "update": Update JSON}
+    用户/会话ID 与文件ID 经 HMAC 映射为稳定的假值 (同一文件内保持对应关系);
+    文本中的字母和数字都被替换, 只保留长度和命令 (纯数字短回复如验证答案例外), 文件名只保留扩展名
+    """
+    
+    ID_KEYS = ("user_id", "chat_id", "sender_chat_id")
+    FILE_ID_KEYS = ("file_id", "file_unique_id")
+    TEXT_KEYS = ("text", "caption", "first_name", "last_name", "username", "title", "question", "quote",
+                 "address", "performer")
+    # 不超过此位数的纯数字消息原样保留 (验证答案), 更长的可能是电话、卡号等
+    MAX_KEPT_NUMBER_LEN = 3
+    
+    def __init__(self):
+        self.file = None
+        self.path = None
+        self.count = 0
+        self._salt = b""
+        self._fixed = {}
+    
+    @property
+    def active(self) -> bool:
+        return self.file is not None
+    
+    def start(self, bot_id: int) -> str:
+        stamp = f"{datetime.now():%Y%m%d_%H%M%S}"
+        self.path = os.path.join(DATA_DIR, f"traffic_{stamp}.ndjson.gz")
+        self.file = gzip.open(self.path, "wt", encoding="utf-8")
+        self.count = 0
+        self._salt = os.urandom(16)
+        self._fixed = {dm.owner_id: RECORD_OWNER_ID, bot_id: RECORD_BOT_ID}
+        meta = {
+            "owner_id": RECORD_OWNER_ID,
+            "bot_id": RECORD_BOT_ID,
+            "operators": [self.anon_id(op) for op in dm.operators],
+            "forum_chat_id": self.anon_id(dm.forum_chat_id) if dm.forum_chat_id else 0,
+            "routing_mode": ROUTING_MODE,
+            "verify_mode": VERIFY_MODE,
+            "version": BOT_VERSION,
+        }
+        self.file.write(json.dumps({"meta": meta}) + "\n")
+        logger.info(f"开始录制流量: {self.path}")
+        return self.path
+    
+    def stop(self):
+        if self.file:
+            self.file.close()
+            logger.info(f"流量录制结束: {self.path} ({self.count} 条)")
+        self.file = None
+    
+    def anon_id(self, value: int) -> int:
+        """真实ID -> 稳定的匿名ID, 保留正负号 (群组/频道为负)"""
+        if value in self._fixed:
+            return self._fixed[value]
+        digest = hmac.new(self._salt, str(abs(value)).encode(), hashlib.sha256).digest()
+        fake = 10**9 + int.from_bytes(digest[:4], "big") % 10**9
+        return -fake if value < 0 else fake
+    
+    def anon_file_id(self, value: str) -> str:
+        """文件ID -> 稳定的假ID; 真实 file_id 配合机器人 token 可以下载到用户的原始文件"""
+        digest = hmac.new(self._salt, value.encode(), hashlib.sha256).digest()[:12]
+        return "anon" + base64.urlsafe_b64encode(digest).decode()
+    
+    @staticmethod
+    def scrub_text(text: str) -> str:
+        """
+        命令之外的字母替换为 x、数字替换为 0 (按 UTF-16 宽度, 使实体偏移仍然有效), 符号/表情保留
+        纯数字的短消息 (验证答案) 原样保留, 回放时验证流程不变
+        """
+        stripped = text.strip()
+        if stripped.isdigit() and len(stripped) <= TrafficRecorder.MAX_KEPT_NUMBER_LEN:
+            return text
+        
+        def mask(c: str) -> str:
+            if c.isdigit():
+                return "0"
+            if c.isalpha():
+                return "x" if ord(c) < 0x10000 else "xx"
+            return c
+        
+        def replace(match):
+            if match.group(1):
+                return match.group(1)
+            return "".join(mask(c) for c in match.group(2))
+        return re.sub(r"(/[A-Za-z_]\w*)|(\S+)", replace, text)
+    
+    def anonymize(self, data):
+        """递归匿名化 Update.to_dict() 的结果"""
+        if isinstance(data, list):
+            return [self.anonymize(item) for item in data]
+        if not isinstance(data, dict):
+            return data
+        # User / Chat 对象带有 type 或 first_name/is_bot 字段
+        is_peer = "id" in data and ("is_bot" in data or "type" in data) and isinstance(data["id"], int)
+        result = {}
+        for key, value in data.items():
+            if key == "id" and is_peer or key in self.ID_KEYS and isinstance(value, int):
+                result[key] = self.anon_id(value)
+            elif key in self.TEXT_KEYS and isinstance(value, str):
+                result[key] = self.scrub_text(value)
+            elif key in self.FILE_ID_KEYS and isinstance(value, str):
+                result[key] = self.anon_file_id(value)
+            elif key == "file_name" and isinstance(value, str):
+                stem, ext = os.path.splitext(value)
+                if not re.fullmatch(r"\.[A-Za-z0-9]{1,5}", ext):
+                    stem, ext = value, ""
+                result[key] = self.scrub_text(stem) + ext
+            elif key == "data" and isinstance(value, str):
+                # 回调数据中的用户ID同样需要映射
+                result[key] = re.sub(r"\d{5,}", lambda m: str(self.anon_id(int(m.group()))), value)
+            elif key in ("url", "phone_number", "vcard"):
+                result[key] = "redacted"
+            elif key in ("latitude", "longitude"):
+                result[key] = 0.0
+            else:
+                result[key] = self.anonymize(value)
+        return result
+    
+    def record(self, update: Update):
+        if not self.file:
+            return
+        entry = {"t": round(time.time(), 3), "update": self.anonymize(update.to_dict())}
+        self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self.count += 1
+
+recorder = TrafficRecorder()
+
+@owner_only
+async def record_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """开关流量录制: /record [on|off]"""
+    action = context.args[0].lower() if context.args else ("off" if recorder.active else "on")
+    if action == "on":
+        if recorder.active:
+            await update.message.reply_html(f"⚠️ 已在录制中: <code>{recorder.path}</code>")
+            return
+        path = recorder.start(context.bot.id)
+        await update.message.reply_html(f"🔴 开始录制匿名流量\n文件: <code>{path}</code>\n结束请发送 /record off")
+    else:
+        if not recorder.active:
+            await update.message.reply_html("当前未在录制")
+            return
+        path, count = recorder.path, recorder.count
+        recorder.stop()
+        await update.message.reply_html(
+            f"⏹️ 录制结束: <b>{count}</b> 条更新\n文件: <code>{path}</code>\n"
+            f"回放: <code>python3 replay_traffic.py {path}</code>"
+        )
+
+# ==================== 后台任务与停机 ====================
+_background_tasks = set()
+
+def start_background(coroutine) -> asyncio.Task:
+    """
+    启动常驻后台任务
+    不使用 application.create_task, 否则 Application.stop() 会一直等待它们结束
+    """
+    task = asyncio.get_running_loop().create_task(coroutine)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+async def periodic_flush():
+    """定时把脏数据落盘"""
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        dm.flush()
+
+def update_keys(update: Update) -> list:
+    """
+    更新的去重键: 更新ID, 以及新消息/按钮回调的内容键
+    同一条消息换了更新ID重复投递时, 内容键仍能识别出来 (编辑消息不算重复)
+    """
+    keys = [f"u:{update.update_id}"]
+    if update.message:
+        keys.append(f"m:{update.message.chat_id}:{update.message.message_id}")
+    elif update.callback_query:
+        keys.append(f"c:{update.callback_query.id}")
+    return keys
+
+async def track_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """记录轮询进度, 跳过已处理过的更新"""
+    keys = update_keys(update)
+    # 只按已处理键判重, 不与 last_update_id 比大小:
+    # Telegram 在长时间无更新后可能从更小的随机值重新编号, 高水位判断会把之后的更新全部丢弃
+    if any(key in dm.processed for key in keys):
+        logger.info(f"跳过重复的更新 {update.update_id}")
+        raise ApplicationHandlerStop
+    
+    for key in keys:
+        dm.processed.add(key)
+    if catchup.active:
+        # 补处理会调整顺序 (主人消息优先), 同一批积压编号连续, 取最大值
+        dm.runtime_state["last_update_id"] = max(dm.runtime_state["last_update_id"], update.update_id)
+    else:
+        dm.runtime_state["last_update_id"] = update.update_id
+    dm.mark_dirty("state")
+    recorder.record(update)
+
+class Lifecycle:
+    """进程所处的阶段, 决定停止信号如何处理"""
+    
+    def __init__(self):
+        self.initialized = False    # post_init 已返回 (此后到 Application.start() 完成前仍未在运行)
+        self.stop_requested = False # post_init 期间收到停止信号
+        self.stopping = False       # 已开始优雅退出
+
+lifecycle = Lifecycle()
+
+def request_shutdown(application: Application):
+    """收到停止信号: 停止接收更新, 超过期限仍未排空则强制落盘退出"""
+    if lifecycle.stopping:
+        return
+    if application.running:
+        lifecycle.stopping = True
+        logger.info("收到停止信号, 开始优雅退出...")
+        asyncio.get_running_loop().call_later(SHUTDOWN_DRAIN_TIMEOUT, force_shutdown)
+        application.stop_running()
+        return
+    if not lifecycle.initialized:
+        # post_init (含积压补处理) 期间只能记下请求:
+        # 补处理在当前更新完成后中止, post_init 结束后直接退出
+        if not lifecycle.stop_requested:
+            logger.info("启动阶段收到停止信号, 初始化结束后退出...")
+            lifecycle.stop_requested = True
+            application.stop_running()
+        return
+    # post_init 已返回但 Application.start() 尚未完成: PTB 已检查过停止标记, 等进入运行状态后再停止
+    asyncio.get_running_loop().call_later(0.1, request_shutdown, application)
+
+def force_shutdown():
+    """排空超时: 保存已有状态后立即退出"""
+    logger.warning(f"处理中的更新 {SHUTDOWN_DRAIN_TIMEOUT}s 内未完成, 强制退出")
+    dm.runtime_state["stopped_at"] = datetime.now().isoformat()
+    dm.flush_all()
+    recorder.stop()
+    logging.shutdown()
+    os._exit(0)
+
+async def post_stop(application: Application):
+    """更新已排空: 发出暂存的摘要, 停止后台任务并落盘全部状态"""
+    await digest.flush()
+    for task in list(_background_tasks):
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    recorder.stop()
+    
+    dm.runtime_state["clean_shutdown"] = True
+    dm.runtime_state["stopped_at"] = datetime.now().isoformat()
+    dm.flush_all()
+    logger.info(f"已安全停止, 最后处理的更新: {dm.runtime_state['last_update_id']}")
+
+# ==================== 积压补处理 ====================
+class CatchUp:
+    """停机后积压更新的补处理状态"""
+    
+    def __init__(self):
+        self.active = False
+        self.acks = Counter()       # 补处理期间送达的用户消息: {user_id: 条数}
+
+catchup = CatchUp()
+
+async def fetch_backlog(bot) -> list:
+    """
+    拉取启动时的积压更新; 不足 CATCHUP_THRESHOLD 时不拉取 (交给正常轮询)
+    每页先追加写入 BACKLOG_FILE 再向服务器确认, 补处理中途崩溃后可从文件继续
+    不用保存的 last_update_id 作起始偏移: Telegram 重新编号后它可能大于所有待取更新,
+    带上它请求会把这些更新一并确认丢弃; 已处理过的由 run_catch_up 按 BACKLOG_DONE_FILE 跳过
+    """
+    raw, offset = [], None
+    if os.path.exists(BACKLOG_FILE):
+        with open(BACKLOG_FILE, 'r', encoding='utf-8') as f:
+            raw = [json.loads(line) for line in f if line.strip()]
+        if raw:
+            offset = raw[-1]["update_id"] + 1
+    elif os.path.exists(BACKLOG_DONE_FILE):
+        # 积压文件已删除但进度残留 (删除两者之间退出), 不能用于新的积压
+        os.remove(BACKLOG_DONE_FILE)
+    
+    page = await bot.get_updates(offset=offset, limit=100, timeout=0, allowed_updates=Update.ALL_TYPES)
+    if not raw and len(page) < CATCHUP_THRESHOLD:
+        return []
+    
+    with open(BACKLOG_FILE, 'a', encoding='utf-8') as f:
+        while page and len(raw) < CATCHUP_MAX_UPDATES:
+            for update in page:
+                data = update.to_dict()
+                raw.append(data)
+                f.write(json.dumps(data, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+            # 带上新 offset 的请求同时确认了上一页
+            page = await bot.get_updates(
+                offset=page[-1].update_id + 1, limit=100, timeout=0, allowed_updates=Update.ALL_TYPES
+            )
+    return [Update.de_json(data, bot) for data in raw]
+
+def order_backlog(updates: list) -> tuple:
+    """
+    主人/客服的消息排在最前; 过期的验证按钮和未验证用户除最后一条外的消息被跳过
+    返回: (排序后的更新, 主人/客服更新数, 跳过数)
+    """
+    staff, rest, latest_unverified = [], [], {}
+    skipped = 0
+    now = time.time()
+    for update in updates:
+        user = update.effective_user
+        if user and dm.is_operator(user.id):
+            staff.append(update)
+            continue
+        if _is_verify_callback(update):
+            parts = update.callback_query.data.split("|")
+            if len(parts) < 4 or not parts[3].isdigit() or int(parts[3]) < now:
+                skipped += 1
+                continue
+        if user and update.message and user.id not in dm.whitelist and not dm.is_blocked(user.id):
+            latest_unverified[user.id] = update.update_id
+        rest.append(update)
+    
+    kept = [u for u in rest
+            if not (u.message and u.effective_user
+                    and latest_unverified.get(u.effective_user.id, u.update_id) != u.update_id)]
+    skipped += len(rest) - len(kept)
+    return staff + kept, len(staff), skipped
+
+async def run_catch_up(application: Application, updates: list):
+    """按用户汇总转发积压消息, 主人回复优先, 最后每人一条回执、主人一条汇总"""
+    started = time.monotonic()
+    # 上次中止前已处理的更新: 去重环只保留最近的消息, 不足以覆盖整个积压
+    done = set()
+    if os.path.exists(BACKLOG_DONE_FILE):
+        with open(BACKLOG_DONE_FILE, 'r', encoding='utf-8') as f:
+            done = {int(line) for line in f if line.strip()}
+        updates = [update for update in updates if update.update_id not in done]
+    ordered, staff_count, skipped = order_backlog(updates)
+    logger.info(f"进入积压补处理: {len(updates)} 条更新 (上次已处理 {len(done)} 条), 跳过 {skipped} 条")
+    
+    catchup.active = True
+    processed = 0
+    try:
+        with open(BACKLOG_DONE_FILE, 'a', encoding='utf-8') as progress:
+            for update in ordered:
+                if lifecycle.stop_requested:
+                    break
+                await application.process_update(update)
+                progress.write(f"{update.update_id}\n")
+                progress.flush()
+                processed += 1
+    finally:
+        catchup.active = False
+    
+    if lifecycle.stop_requested:
+        # 保留 BACKLOG_FILE 和进度, 下次启动从文件继续 (已处理的按 BACKLOG_DONE_FILE 跳过)
+        logger.info(f"收到停止信号, 积压补处理中止: 已处理 {processed}/{len(ordered)} 条")
+        return
+    
+    await digest.flush()
+    acks, catchup.acks = catchup.acks, Counter()
+    
+    async def send_ack(user_id: int):
+        await application.bot.send_message(
+            chat_id=user_id, text=f"✅ 你在机器人离线期间发送的 {acks[user_id]} 条消息已送达"
+        )
+    await fan_out(acks, send_ack)
+    
+    dm.flush()
+    os.remove(BACKLOG_FILE)
+    os.remove(BACKLOG_DONE_FILE)
+    elapsed = time.monotonic() - started
+    logger.info(f"积压补处理完成: {len(ordered)} 条, 耗时 {elapsed:.1f}s")
+    try:
+        await call_with_retry(lambda: application.bot.send_message(
+            chat_id=dm.owner_id,
+            text=(
+                f"🔄 <b>积压补处理完成</b> ({elapsed:.1f}s)\n\n"
+                f"共 {len(updates)} 条更新\n"
+                f"👤 主人/客服消息优先处理: {staff_count} 条\n"
+                f"📨 用户消息: {sum(acks.values())} 条 / {len(acks)} 人\n"
+                f"⏭️ 跳过过期验证: {skipped} 条"
+            ),
+            parse_mode=ParseMode.HTML
+        ))
+    except TelegramError as e:
+        logger.error(f"补处理汇总发送失败: {e}")
 
 # ==================== 启动和错误处理 ====================
 async def post_init(application: Application):
     """启动后初始化"""
+    # 尽早接管停止信号, 积压补处理期间也能优雅退出
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, request_shutdown, application)
+        except (NotImplementedError, RuntimeError):
+            pass  # Windows 不支持, 由 KeyboardInterrupt 兜底
+    
     dm.load_all()
+    await content_filter.reload()
+    warm_restart = dm.runtime_state.get("clean_shutdown", False)
+    stopped_at = dm.runtime_state.get("stopped_at")
+    # 运行期间标记为未正常退出, 崩溃后下次启动按冷启动处理
+    dm.runtime_state["clean_shutdown"] = False
+    dm.save_state()
+    
+    # 检查积压; 未确认的更新里已处理过的部分由 track_update 按去重键跳过
+    last_update_id = dm.runtime_state["last_update_id"]
+    try:
+        backlog = await fetch_backlog(application.bot)
+    except TelegramError as e:
+        logger.warning(f"拉取积压更新失败: {e}")
+        backlog = []
+    
+    start_background(periodic_flush())
+    start_background(outbox.run(application.bot))
+    loop_monitor.start(application)
+    
+    if backlog:
+        await run_catch_up(application, backlog)
+    
+    if not lifecycle.stop_requested:
+        await notify_started(application, warm_restart, stopped_at, last_update_id)
+    if lifecycle.stop_requested:
+        # post_init 中请求停止时 PTB 不会调用 post_stop, 在这里完成收尾
+        await post_stop(application)
+    else:
+        lifecycle.initialized = True
+
+async def notify_started(application: Application, warm_restart: bool, stopped_at, last_update_id: int):
+    """启动通知: 热重启只报停机时长, 冷启动附带数据概况"""
+    if warm_restart:
+        downtime = ""
+        if stopped_at:
+            seconds = (datetime.now() - datetime.fromisoformat(stopped_at)).total_seconds()
+            downtime = f" (停机 {seconds:.1f}s)"
+        logger.info(f"热重启完成{downtime}, 上次处理到更新 {last_update_id}")
+        try:
+            await application.bot.send_message(
+                chat_id=dm.owner_id,
+                text=f"♻️ 机器人已重启 (V{BOT_VERSION}){downtime}"
+            )
+        except TelegramError as e:
+            logger.error(f"启动通知发送失败: {e}")
+        return
     
     try:
         await application.bot.send_message(
@@ -558,43 +3359,72 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     logger.error("异常:", exc_info=context.error)
 
 # ==================== 主函数 ====================
-def main():
-    """启动机器人"""
-    dm._load_config()  # 预加载配置获取token
-    
+def build_application(builder) -> Application:
+    """在给定的 builder 上注册全部处理器 (正式运行与流量回放共用)"""
     application = (
-        Application.builder()
-        .token(dm.bot_token)
+        builder
         .post_init(post_init)
+        .post_stop(post_stop)
+        .context_types(ContextTypes(context=BotContext))
         .build()
     )
     
+    # 轮询进度记录 (最先执行)
+    application.add_handler(TypeHandler(Update, track_update), group=-100)
+    # 访问控制中间件 (每个更新执行一次)
+    application.add_handler(TypeHandler(Update, access_middleware), group=-1)
+    
     # 命令处理器
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("stats", stats_command))
     application.add_handler(CommandHandler("banlist", banlist_command))
+    application.add_handler(CommandHandler("whitelist", whitelist_command))
     application.add_handler(CommandHandler("unban", unban_command))
-    application.add_handler(CommandHandler("broadcast", broadcast_command))
+    application.add_handler(CommandHandler("broadcast", broadcast_command, block=False))
     application.add_handler(CommandHandler("clear", clear_command))
+    application.add_handler(CommandHandler("import", import_command, block=False))
+    application.add_handler(CommandHandler("export", export_command))
+    application.add_handler(CommandHandler("profile", profile_command, block=False))
+    application.add_handler(CommandHandler("memstats", memstats_command))
+    application.add_handler(CommandHandler("record", record_command))
+    application.add_handler(CommandHandler("filter", filter_command))
+    application.add_handler(CommandHandler("assign", assign_command))
     
-    # 回调处理器
+    # 回调处理器 (验证按钮来自陌生人, 需在主人回调之前匹配)
+    application.add_handler(CallbackQueryHandler(ButtonVerification.handle_answer, pattern=r"^v\|"))
     application.add_handler(CallbackQueryHandler(callback_handler))
     
     # 消息处理器
+    if dm.forum_chat_id:
+        application.add_handler(MessageHandler(
+            filters.Chat(dm.forum_chat_id) & ~filters.COMMAND & ~filters.StatusUpdate.ALL,
+            topic_reply_handler
+        ))
     application.add_handler(MessageHandler(
-        filters.Chat(dm.owner_id) & filters.REPLY & ~filters.COMMAND,
+        filters.Chat(dm.operator_pool()) & filters.REPLY & ~filters.COMMAND,
         reply_handler
     ))
     application.add_handler(MessageHandler(
-        filters.ALL & ~filters.COMMAND,
+        filters.ChatType.PRIVATE & ~filters.COMMAND,
         forward_message_handler
     ))
     
     application.add_error_handler(error_handler)
+    return application
+
+def main():
+    """启动机器人"""
+    dm._load_config()  # 预加载配置获取token
+    builder = Application.builder().token(dm.bot_token)
+    if dm.api_base_url:
+        builder = builder.base_url(dm.api_base_url)
+        logger.info(f"使用自定义 Bot API 地址: {dm.api_base_url}")
+    application = build_application(builder)
     
     logger.info(f"机器人启动中 (V{BOT_VERSION})...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    # 停止信号由 post_init 中注册的 request_shutdown 处理
+    application.run_polling(allowed_updates=Update.ALL_TYPES, stop_signals=None)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,173 @@
+# migrate_legacy.py - 旧版 (v4 ~ v6) 数据迁移到 v7
+#
+# 用法: python3 migrate_legacy.py [旧版工作目录]
+#
+# v4 ~ v6 在工作目录保存 user_mapping.json, v6 另有 manual_ban_list.json;
+# v7 统一保存在 data/ 下。映射文件可能有几百 MB, 这里按块流式解析,
+# 内存占用与文件大小无关; 每处理一块记录一次断点, 中断后重新运行会从断点继续,
+# 已完成的迁移再次运行会直接跳过。
+# 迁移期间请先停止机器人, 否则机器人落盘时会覆盖迁移结果。
+import argparse
+import json
+import os
+import re
+import sys
+
+from forwarder_bot_v7 import DATA_DIR, MAPPING_FILE, BLACKLIST_FILE
+
+LEGACY_MAPPING = 'user_mapping.json'
+LEGACY_BAN_LIST = 'manual_ban_list.json'
+MIGRATION_STATE_FILE = os.path.join(DATA_DIR, 'migration_state.json')
+
+CHUNK_SIZE = 1 << 20    # 每次读取 1MB
+MAX_TAIL = 128          # 无匹配时保留的最大尾部字节, 足够容纳一个完整键值对
+
+# 旧版映射格式: {"消息ID": 用户ID, ...}
+PAIR_RE = re.compile(rb'"(-?\d+)"\s*:\s*(-?\d+)')
+
+# ==================== 流式解析 ====================
+def iter_pairs(f, offset: int = 0):
+    """
+    从 offset 开始流式解析扁平 JSON 对象
+    逐个产出 (解析到的文件位置, 键, 值), 文件位置可作为续传断点
+    """
+    f.seek(offset)
+    buf = b""
+    base = offset
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        eof = not chunk
+        buf += chunk
+        last_end = 0
+        for m in PAIR_RE.finditer(buf):
+            # 值的数字可能被块边界截断, 非末尾才可信
+            if m.end() == len(buf) and not eof:
+                break
+            last_end = m.end()
+            yield base + last_end, int(m.group(1)), int(m.group(2))
+        if eof:
+            return
+        if last_end == 0 and len(buf) > MAX_TAIL:
+            last_end = len(buf) - MAX_TAIL
+        buf = buf[last_end:]
+        base += last_end
+
+# ==================== 断点状态 ====================
+def load_state() -> dict:
+    try:
+        with open(MIGRATION_STATE_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_state(state: dict):
+    tmp_path = MIGRATION_STATE_FILE + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, MIGRATION_STATE_FILE)
+
+def source_identity(path: str) -> dict:
+    st = os.stat(path)
+    return {"source": os.path.abspath(path), "size": st.st_size, "mtime": st.st_mtime}
+
+def print_progress(label: str, done: int, total: int, count: int):
+    percent = done * 100 / total if total else 100
+    print(f"\r{label}: {percent:5.1f}% ({count} 条)", end="", flush=True)
+
+# ==================== 迁移步骤 ====================
+def migrate_mapping(legacy_dir: str, state: dict):
+    """流式迁移消息映射, 与 v7 现有映射合并 (v7 的记录优先)"""
+    source = os.path.join(legacy_dir, LEGACY_MAPPING)
+    if not os.path.exists(source):
+        print(f"未找到 {source}, 跳过映射迁移")
+        return
+
+    identity = source_identity(source)
+    job = state.get("mapping", {})
+    if {k: job.get(k) for k in identity} != identity:
+        job = dict(identity, source_offset=0, output_offset=0, count=0, done=False)
+    if job["done"]:
+        print(f"{source} 已迁移过, 跳过")
+        return
+
+    partial_path = MAPPING_FILE + '.migrating'
+    if job["output_offset"] == 0 or not os.path.exists(partial_path):
+        job.update(source_offset=0, output_offset=0, count=0)
+        with open(partial_path, 'wb') as out:
+            out.write(b"{")
+            job["output_offset"] = out.tell()
+
+    total = identity["size"]
+    with open(source, 'rb') as src, open(partial_path, 'r+b') as out:
+        # 丢弃断点之后未确认的输出
+        out.truncate(job["output_offset"])
+        out.seek(job["output_offset"])
+
+        last_checkpoint = job["source_offset"]
+        for position, key, value in iter_pairs(src, job["source_offset"]):
+            out.write(b'%s\n"%d": %d' % (b"," if job["count"] else b"", key, value))
+            job["count"] += 1
+            job["source_offset"] = position
+            if position - last_checkpoint >= CHUNK_SIZE:
+                out.flush()
+                job["output_offset"] = out.tell()
+                state["mapping"] = job
+                save_state(state)
+                last_checkpoint = position
+                print_progress("映射", position, total, job["count"])
+
+        # 追加 v7 现有映射, 重复键以最后出现的为准
+        if os.path.exists(MAPPING_FILE):
+            with open(MAPPING_FILE, 'rb') as current:
+                for _, key, value in iter_pairs(current):
+                    out.write(b'%s\n"%d": %d' % (b"," if job["count"] else b"", key, value))
+                    job["count"] += 1
+        out.write(b"\n}\n")
+
+    os.replace(partial_path, MAPPING_FILE)
+    job["done"] = True
+    state["mapping"] = job
+    save_state(state)
+    print_progress("映射", total, total, job["count"])
+    print(f"\n映射迁移完成 -> {MAPPING_FILE}")
+
+def migrate_ban_list(legacy_dir: str, state: dict):
+    """合并 v6 的手动黑名单 (集合合并, 重复运行无副作用)"""
+    source = os.path.join(legacy_dir, LEGACY_BAN_LIST)
+    if not os.path.exists(source):
+        print(f"未找到 {source}, 跳过黑名单迁移")
+        return
+
+    with open(source, 'r', encoding='utf-8') as f:
+        legacy = {int(uid) for uid in json.load(f)}
+    current = set()
+    if os.path.exists(BLACKLIST_FILE):
+        with open(BLACKLIST_FILE, 'r', encoding='utf-8') as f:
+            current = set(json.load(f))
+
+    merged = sorted(current | legacy)
+    tmp_path = BLACKLIST_FILE + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(merged, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, BLACKLIST_FILE)
+
+    state["ban_list"] = dict(source_identity(source), done=True)
+    save_state(state)
+    print(f"黑名单迁移完成: 新增 {len(merged) - len(current)} 人, 共 {len(merged)} 人")
+
+def main():
+    parser = argparse.ArgumentParser(description="将 v4 ~ v6 的数据迁移到 v7 的 data/ 目录")
+    parser.add_argument("legacy_dir", nargs="?", default=".", help="旧版机器人的工作目录")
+    args = parser.parse_args()
+
+    os.makedirs(DATA_DIR, exist_ok=True)
+    state = load_state()
+    try:
+        migrate_mapping(args.legacy_dir, state)
+        migrate_ban_list(args.legacy_dir, state)
+    except KeyboardInterrupt:
+        print("\n已中断, 重新运行将从断点继续")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+# replay_traffic.py - 回放 /record 录制的匿名流量, 用于回归性能对比
+#
+# 用法: python3 replay_traffic.py traffic_xxx.ndjson.gz [--speed 10] [--out run.json] [--baseline old.json]
+#
+# 回放在临时工作目录中进行 (独立的 config.ini 与 data/), 不会触碰正式数据;
+# 每条更新经由与正式运行完全相同的 Application 处理器, Bot API 调用由模拟请求层应答,
+# 不产生任何网络流量。结果包含每条更新的处理延迟分位数与各 API 方法的调用次数,
+# 指定 --baseline 时与上一次的结果逐项对比。
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+
+from telegram import Update
+from telegram.ext import Application
+from telegram.request import BaseRequest
+
+from fake_bot_api import simulate_result
+
+REPLAY_TOKEN = "123456:replay"
+
+# 机器人模块在切换到临时工作目录后才导入 (见 main): 导入时会在当前目录打开 bot.log,
+# 提前导入会把回放日志写进正式运行的日志文件
+bot_module = None
+
+# ==================== 模拟 Bot API ====================
+class SimulatedRequest(BaseRequest):
+    """替代 HTTP 请求层: 记录每个 API 调用并按固定延迟返回模拟结果"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.bot_user = {"id": bot_module.RECORD_BOT_ID, "is_bot": True,
+                         "first_name": "Replay", "username": "replay_bot"}
+        self._message_id = 10**6
+
+    def next_id(self) -> int:
+        self._message_id += 1
+        return self._message_id
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[api_method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        result = simulate_result(api_method, params, self.bot_user, self.next_id)
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+# ==================== 回放 ====================
+def read_records(path: str):
+    """产出 (元信息, 更新记录迭代器)"""
+    f = gzip.open(path, "rt", encoding="utf-8")
+    first = json.loads(f.readline() or "{}")
+    meta = first.get("meta", {})
+
+    def records():
+        with f:
+            if "update" in first:
+                yield first
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    return meta, records()
+
+def write_config(meta: dict):
+    """在临时工作目录写入与录制时对应的配置"""
+    operators = ",".join(str(op) for op in meta.get("operators", []))
+    with open(bot_module.CONFIG_FILE, "w", encoding="utf-8") as f:
+        f.write("[Telegram]\n"
+                f"BOT_TOKEN = {REPLAY_TOKEN}\n"
+                f"OWNER_ID = {meta.get('owner_id', bot_module.RECORD_OWNER_ID)}\n"
+                f"FORUM_CHAT_ID = {meta.get('forum_chat_id', 0)}\n"
+                f"OPERATORS = {operators}\n")
+    os.makedirs(bot_module.DATA_DIR, exist_ok=True)
+
+def percentile(ordered: list, q: float) -> float:
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+async def replay(path: str, speed: float, api_latency: float) -> dict:
+    meta, records = read_records(path)
+    bot_module.ROUTING_MODE = meta.get("routing_mode", bot_module.ROUTING_MODE)
+    bot_module.VERIFY_MODE = meta.get("verify_mode", bot_module.VERIFY_MODE)
+    write_config(meta)
+    bot_module.dm.load_all()
+
+    request = SimulatedRequest(api_latency)
+    application = bot_module.build_application(
+        Application.builder().token(REPLAY_TOKEN).request(request).get_updates_request(SimulatedRequest())
+    )
+    errors = Counter()
+
+    async def count_error(update, context):
+        errors[type(context.error).__name__] += 1
+    application.add_error_handler(count_error)
+
+    await application.initialize()
+    request.calls.clear()  # 不计入初始化时的 getMe
+    latencies = []
+    started = time.perf_counter()
+    first_t = None
+    try:
+        for record in records:
+            if first_t is None:
+                first_t = record["t"]
+            if speed > 0:
+                # 按录制时的间隔 (除以倍速) 投递, 处理落后时不再等待
+                delay = (record["t"] - first_t) / speed - (time.perf_counter() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            update = Update.de_json(record["update"], application.bot)
+            begin = time.perf_counter()
+            await application.process_update(update)
+            latencies.append((time.perf_counter() - begin) * 1000)
+            if len(latencies) % 1000 == 0:
+                print(f"\r已回放 {len(latencies)} 条", end="", flush=True)
+    finally:
+        await application.shutdown()
+        for task in list(bot_module._background_tasks):
+            task.cancel()
+    wall = time.perf_counter() - started
+
+    ordered = sorted(latencies)
+    return {
+        "file": os.path.basename(path),
+        "version": bot_module.BOT_VERSION,
+        "speed": speed,
+        "api_latency_ms": api_latency * 1000,
+        "updates": len(latencies),
+        "wall_seconds": round(wall, 3),
+        "latency_ms": {
+            "mean": round(sum(ordered) / len(ordered), 3) if ordered else 0.0,
+            "p50": round(percentile(ordered, 0.50), 3),
+            "p95": round(percentile(ordered, 0.95), 3),
+            "p99": round(percentile(ordered, 0.99), 3),
+            "max": round(ordered[-1], 3) if ordered else 0.0,
+        },
+        "api_calls": dict(request.calls.most_common()),
+        "api_total": sum(request.calls.values()),
+        "errors": dict(errors),
+    }
+
+# ==================== 报告 ====================
+def format_change(old: float, new: float) -> str:
+    if not old:
+        return f"{new}"
+    return f"{old} -> {new} ({(new - old) / old * 100:+.1f}%)"
+
+def print_report(result: dict, baseline: dict = None):
+    print(f"\n回放 {result['file']}: {result['updates']} 条更新, 耗时 {result['wall_seconds']}s")
+    print("处理延迟 (ms):")
+    for key, value in result["latency_ms"].items():
+        old = baseline["latency_ms"].get(key) if baseline else None
+        print(f"  {key:>4}: {format_change(old, value) if baseline else value}")
+    print(f"API 调用 (共 {result['api_total']}):")
+    methods = set(result["api_calls"]) | set(baseline["api_calls"] if baseline else ())
+    for method in sorted(methods):
+        new = result["api_calls"].get(method, 0)
+        if baseline:
+            old = baseline["api_calls"].get(method, 0)
+            marker = "" if old == new else f"  ({new - old:+d})"
+            print(f"  {method}: {old} -> {new}{marker}")
+        else:
+            print(f"  {method}: {new}")
+    if result["errors"]:
+        print(f"处理器异常: {result['errors']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="回放录制的流量并统计延迟与 API 调用次数")
+    parser.add_argument("recording", help="/record 生成的 .ndjson.gz 文件")
+    parser.add_argument("--speed", type=float, default=1.0, help="回放倍速, 0 表示不等待尽快回放")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="模拟每次 API 调用的延迟(秒)")
+    parser.add_argument("--out", help="将结果写入 JSON 文件, 可作为下次的 --baseline")
+    parser.add_argument("--baseline", help="与之前的结果文件对比")
+    args = parser.parse_args()
+
+    recording = os.path.abspath(args.recording)
+    out = os.path.abspath(args.out) if args.out else None
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    # 在临时目录中运行, 隔离正式的 config.ini 与 data/
+    global bot_module
+    with tempfile.TemporaryDirectory(prefix="replay_") as workdir:
+        os.chdir(workdir)
+        import forwarder_bot_v7 as bot_module
+        try:
+            result = asyncio.run(replay(recording, args.speed, args.api_latency))
+        except KeyboardInterrupt:
+            print("\n已中断")
+            sys.exit(1)
+
+    print_report(result, baseline)
+    if out:
+        with open(out, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"结果已写入 {out}")
+
+if __name__ == '__main__':
+    main()